@@ -0,0 +1,134 @@
+'''
+The file format shared by --record recordings (escrecord) and the archive of
+test cases written for --test-case-dir (esccases).
+
+A file starts with a magic number, which says what it holds, followed by a
+header of a size fixed for that kind of file. Then come records, each of
+which is a kind, the length of its data and the data. When a writer is
+closed it appends an INDEX record giving the offsets of the records it
+chooses, which ends with a trailer giving the offset of the INDEX record
+itself. Readers find the index through the trailer. If there is none,
+because the writer was cut off, they read the records from start to end
+instead. A file can be reopened to append records and another index.
+'''
+
+import mmap
+import os
+import struct
+
+import esctypes
+
+# The kind of an index record; other kinds are up to the kind of file.
+INDEX = 0
+
+TRAILER_MAGIC = b"ESCIDX01"
+
+RECORD_HEADER = struct.Struct("<BI")
+# The offset of the INDEX record and the number of offsets in it.
+TRAILER = struct.Struct("<QI8s")
+
+class ArchiveReader(object):
+  """A file of records read from |path| through mmap. |header| holds the
+  |headerSize| bytes after |magic|, |offsets| those of the records in the
+  index, or of every record but the indexes if there is none, and |end|
+  where the last complete record ends."""
+  def __init__(self, path, magic, headerSize=0):
+    self._start = len(magic) + headerSize
+    if os.path.getsize(path) < self._start:
+      raise esctypes.InternalError("%s is too short" % path)
+    with open(path, "rb") as f:
+      self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if self._map[:len(magic)] != magic:
+      self._map.close()
+      raise esctypes.InternalError("%s does not start with %s" % (
+          path, repr(magic)))
+    self.header = self._map[len(magic):self._start]
+    self.end = len(self._map)
+    self.offsets = self.ReadIndex()
+    if self.offsets is None:
+      self.offsets = self.ScanRecords()
+
+  def ReadIndex(self):
+    """Returns the offsets in the index at the end, or None if there is
+    none."""
+    size = len(self._map)
+    if size < self._start + RECORD_HEADER.size + TRAILER.size:
+      return None
+    indexOffset, count, magic = TRAILER.unpack_from(self._map,
+                                                    size - TRAILER.size)
+    if (magic != TRAILER_MAGIC or indexOffset < self._start or
+        indexOffset + RECORD_HEADER.size > size):
+      return None
+    kind, length = RECORD_HEADER.unpack_from(self._map, indexOffset)
+    if (kind != INDEX or length != count * 8 + TRAILER.size or
+        indexOffset + RECORD_HEADER.size + length != size):
+      return None
+    return list(struct.unpack_from("<%dQ" % count, self._map,
+                                   indexOffset + RECORD_HEADER.size))
+
+  def ScanRecords(self):
+    """Returns the offsets of the complete records other than indexes, and
+    sets |end| to where the last of them ends."""
+    offsets = []
+    offset = self._start
+    while offset + RECORD_HEADER.size <= len(self._map):
+      kind, length = RECORD_HEADER.unpack_from(self._map, offset)
+      end = offset + RECORD_HEADER.size + length
+      if end > len(self._map):
+        break
+      if kind != INDEX:
+        offsets.append(offset)
+      offset = end
+    self.end = offset
+    return offsets
+
+  def Record(self, offset):
+    """Returns the kind of the record at |offset| and the offset and length
+    of its data."""
+    kind, length = RECORD_HEADER.unpack_from(self._map, offset)
+    return kind, offset + RECORD_HEADER.size, length
+
+  def Data(self, start, length):
+    return self._map[start:start + length]
+
+  def Close(self):
+    self._map.close()
+
+class ArchiveWriter(object):
+  """Writes records to a file at |path| which starts with |magic| and
+  |header|. With |append|, a file already at |path| is added to instead."""
+  def __init__(self, path, magic, header=b"", append=False):
+    if append and os.path.exists(path) and os.path.getsize(path) > 0:
+      reader = ArchiveReader(path, magic, len(header))
+      end = reader.end
+      reader.Close()
+      self._file = open(path, "r+b")
+      # Drop what a writer which was cut off left of its last record.
+      self._file.truncate(end)
+      self._file.seek(end)
+      self._offset = end
+    else:
+      self._file = open(path, "wb")
+      self._file.write(magic + header)
+      self._offset = len(magic) + len(header)
+
+  def Append(self, kind, *parts):
+    """Add a record whose data is |parts| put together, and return its
+    offset."""
+    offset = self._offset
+    length = sum(map(len, parts))
+    self._file.write(RECORD_HEADER.pack(kind, length))
+    for part in parts:
+      self._file.write(part)
+    self._offset += RECORD_HEADER.size + length
+    return offset
+
+  def Flush(self):
+    self._file.flush()
+
+  def Close(self, offsets):
+    """Write an index of the records at |offsets| and close the file."""
+    self.Append(INDEX,
+                struct.pack("<%dQ" % len(offsets), *offsets),
+                TRAILER.pack(self._offset, len(offsets), TRAILER_MAGIC))
+    self._file.close()
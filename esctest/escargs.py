@@ -9,6 +9,10 @@ ALLOW_C2_CONTROLS = "allowC2Controls"
 
 ACTION_RUN = "run"
 ACTION_LIST_KNOWN_BUGS = "list-known-bugs"
+ACTION_BENCH_LATENCY = "bench-latency"
+ACTION_BENCH_THROUGHPUT = "bench-throughput"
+ACTION_BENCH_SCROLL = "bench-scroll"
+ACTION_BENCH_RECT = "bench-rect"
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--include",
@@ -22,7 +26,7 @@ parser.add_argument("--no-print-logs",
                     help="Print logs after finishing?",
                     action="store_true")
 parser.add_argument("--test-case-dir",
-                    help="Create files with test cases in the specified directory",
+                    help="Write what each test sends to an archive, test-cases.esca, in the specified directory",
                     default=None)
 parser.add_argument("--stop-on-failure",
                     help="Stop running tests after a failure.",
@@ -47,10 +51,53 @@ parser.add_argument("--xterm-checksum",
                     help="Specify version-specific xterm checksum calculation.",
                     type=int,
                     default=0)
+parser.add_argument("--hierarchical-checksum",
+                    help="Check the checksum of a whole rect before reading its cells.",
+                    action="store_true")
+parser.add_argument("--incremental-reset",
+                    help="Between tests, undo only the state which the last test changed.",
+                    action="store_true")
+parser.add_argument("--verify-reset",
+                    help="Check that each reset restores the modes found after the first one.",
+                    action="store_true")
 parser.add_argument("--xterm-reverse-wrap",
                     help="Specify version-specific xterm reverse-wrap movement.",
                     type=int,
                     default=0)
+parser.add_argument("--results-cache",
+                    help="Record the outcome of each test in this file, keyed by its source, the options and the terminal.",
+                    default=None)
+parser.add_argument("--reuse-results",
+                    help="Skip tests whose outcome is in --results-cache under the same key.",
+                    action="store_true")
+parser.add_argument("--shards",
+                    help="Run the tests in this many terminals at once.",
+                    default=0,
+                    type=int)
+parser.add_argument("--terminal-command",
+                    help="Command which runs its arguments in a new terminal, for --shards.",
+                    default="xterm -e")
+parser.add_argument("--durations-file",
+                    help="File of test durations, used by --shards to balance terminals and updated after each run.",
+                    default=None)
+parser.add_argument("--test-list",
+                    help="File naming the tests to run, one per line.",
+                    default=None)
+parser.add_argument("--results-file",
+                    help="Write the outcome of each test to this file, as JSON.",
+                    default=None)
+parser.add_argument("--headless",
+                    help="Run against the built-in model of xterm instead of a real terminal.",
+                    action="store_true")
+parser.add_argument("--differential",
+                    help="Also send everything to the built-in model of xterm, and log where the terminal's replies first differ from the model's in each test.",
+                    action="store_true")
+parser.add_argument("--record",
+                    help="Write everything sent to the terminal, and its replies, to this file.",
+                    default=None)
+parser.add_argument("--replay",
+                    help="Instead of a terminal, play back the replies in a file written by --record. Stops at the first difference from what was recorded.",
+                    default=None)
 parser.add_argument("--window-id",
                     help="X Window identifier",
                     default=0,
@@ -62,8 +109,24 @@ parser.add_argument("--v",
 parser.add_argument("--action",
                     help="Action to perform.",
                     default=ACTION_RUN,
-                    choices=[ACTION_RUN, ACTION_LIST_KNOWN_BUGS])
+                    choices=[ACTION_RUN, ACTION_LIST_KNOWN_BUGS,
+                             ACTION_BENCH_LATENCY, ACTION_BENCH_THROUGHPUT,
+                             ACTION_BENCH_SCROLL, ACTION_BENCH_RECT])
+parser.add_argument("--bench-iterations",
+                    help="Number of times a benchmark repeats each measurement.",
+                    default=1000,
+                    type=int)
+parser.add_argument("--bench-bytes",
+                    help="Amount of text which bench-throughput writes for each kind of text.",
+                    default=1000000,
+                    type=int)
+parser.add_argument("--bench-output",
+                    help="Append benchmark results to this file, as one JSON object per line.",
+                    default=None)
 parser.add_argument("--timeout",
                     help="Timeout for reading reports from terminal.",
                     default=1,
                     type=float)
+parser.add_argument("--adaptive-timeout",
+                    help="Derive timeouts from measured latency, up to --timeout.",
+                    action="store_true")
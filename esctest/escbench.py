@@ -0,0 +1,321 @@
+'''
+Benchmarks of the terminal under test, selected with --action. Each one logs
+its results and, with --bench-output, appends them to that file as JSON, one
+object per line, along with the expected terminal and its replies to DA, DA2
+and XTVERSION so that runs against different builds can be told apart.
+'''
+
+import json
+import time
+
+import esc
+import escargs
+import esccache
+import esccmd
+import escio
+from esclog import LogInfo
+import esctypes
+import escutil
+from esctypes import Point, Rect
+
+# Upper bounds in milliseconds of the buckets of latency histograms.
+HISTOGRAM_BUCKETS = [0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000]
+HISTOGRAM_WIDTH = 40
+
+# How long to wait for the terminal to finish processing a benchmark's output.
+PROCESSING_LIMIT = 600
+
+gFingerprint = None
+
+def Run(action):
+  BENCHMARKS[action]()
+
+def Record(benchmark, case, **values):
+  """Log one result of |benchmark| and append it to --bench-output."""
+  global gFingerprint
+  LogInfo("%s %s: %s" % (benchmark, case,
+                         ", ".join("%s=%s" % (name, FormatValue(values[name]))
+                                   for name in sorted(values))))
+  if escargs.args.bench_output:
+    if gFingerprint is None:
+      gFingerprint = esccache.TerminalFingerprint()
+    record = {"benchmark": benchmark,
+              "case": case,
+              "terminal": escargs.args.expected_terminal,
+              "fingerprint": gFingerprint}
+    record.update(values)
+    with open(escargs.args.bench_output, "a") as f:
+      f.write(json.dumps(record, sort_keys=True) + "\n")
+
+def FormatValue(value):
+  if isinstance(value, float):
+    return "%.4g" % value
+  return str(value)
+
+def Histogram(samples):
+  """Returns lines drawing a histogram of |samples|, in seconds."""
+  counts = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+  for sample in samples:
+    i = 0
+    while i < len(HISTOGRAM_BUCKETS) and sample * 1000 >= HISTOGRAM_BUCKETS[i]:
+      i += 1
+    counts[i] += 1
+  lines = []
+  for i, count in enumerate(counts):
+    if count == 0:
+      continue
+    if i < len(HISTOGRAM_BUCKETS):
+      label = "< %gms" % HISTOGRAM_BUCKETS[i]
+    else:
+      label = ">= %gms" % HISTOGRAM_BUCKETS[-1]
+    bar = "#" * max(1, count * HISTOGRAM_WIDTH // max(counts))
+    lines.append("%10s %6d %s" % (label, count, bar))
+  return lines
+
+def ClearScreen():
+  """Put back the margins, attributes and cursor which benchmarks change, and
+  clear the screen."""
+  esccmd.SGR(0)
+  esccmd.DECSTBM()
+  if esc.vtLevel >= 4:
+    esccmd.DECSET(esccmd.DECLRMM)
+    esccmd.DECSLRM(1, escutil.GetScreenSize().width())
+    esccmd.DECRESET(esccmd.DECLRMM)
+  esccmd.ED(2)
+  esccmd.CUP(Point(1, 1))
+
+def FillRows(count):
+  """Write text to the first |count| rows of the screen."""
+  width = escutil.GetScreenSize().width()
+  for y in range(1, count + 1):
+    esccmd.CUP(Point(1, y))
+    escio.Write("".join(chr(ord("a") + (x + y) % 26) for x in range(width)))
+
+def WaitUntilProcessed():
+  """Send a CPR request and wait for the reply, which the terminal sends once
+  it has processed everything written before it. Unlike an ordinary read,
+  this waits up to PROCESSING_LIMIT seconds."""
+  esccmd.DSR(esccmd.DSRCPR)
+  deadline = time.time() + PROCESSING_LIMIT
+  while True:
+    try:
+      return escio.ReadCSI("R")
+    except esctypes.InternalError:
+      if time.time() > deadline:
+        raise
+
+def LatencyQueries():
+  """Returns (name, function) pairs for each query which the terminal is
+  expected to answer at its VT level. Each function sends a query and reads
+  the reply."""
+  def CPR():
+    esccmd.DSR(esccmd.DSRCPR)
+    escio.ReadCSI("R")
+
+  def DA():
+    esccmd.DA()
+    escio.ReadCSI("c", "?")
+
+  def DECRQCRA():
+    escutil.GetChecksumOfRect(Rect(1, 1, 10, 10))
+
+  def DECRQSS():
+    esccmd.DECRQSS("m")
+    escio.ReadDCS()
+
+  queries = [("CPR", CPR), ("DA", DA)]
+  if esc.vtLevel >= 3:
+    queries.append(("DECRQSS", DECRQSS))
+  if esc.vtLevel >= 4:
+    queries.append(("DECRQCRA", DECRQCRA))
+  return queries
+
+def BenchLatency():
+  """Measure the round-trip time of queries on screens of varying fullness,
+  with and without a scroll region."""
+  height = escutil.GetScreenSize().height()
+  screens = [("empty", 0, False),
+             ("half full", height // 2, False),
+             ("full", height, False),
+             ("full with scroll region", height, True)]
+  for screen, rows, region in screens:
+    ClearScreen()
+    FillRows(rows)
+    if region:
+      esccmd.DECSTBM(2, height - 1)
+    for name, query in LatencyQueries():
+      samples = []
+      try:
+        for _ in range(escargs.args.bench_iterations):
+          start = time.time()
+          query()
+          samples.append(time.time() - start)
+      except esctypes.InternalError as e:
+        LogInfo("%s %s, %s screen: no reply, skipped (%s)" % (
+            escargs.ACTION_BENCH_LATENCY, name, screen, str(e)))
+        escio.Resync()
+        continue
+      samples.sort()
+      Record(escargs.ACTION_BENCH_LATENCY, "%s, %s screen" % (name, screen),
+             iterations=len(samples),
+             p50_ms=escio.Percentile(samples, 50) * 1000,
+             p95_ms=escio.Percentile(samples, 95) * 1000,
+             p99_ms=escio.Percentile(samples, 99) * 1000)
+      for line in Histogram(samples):
+        LogInfo(line)
+  ClearScreen()
+
+def ThroughputTexts():
+  """Returns (name, bytes) pairs of a line of text to repeat for each kind of
+  text which the terminal is expected to handle. Each line ends with CR LF
+  and stops one column short of the right margin so it does not wrap."""
+  width = escutil.GetScreenSize().width()
+  narrow = width - 1
+  wide_chars = escargs.args.options is None or escargs.DISABLE_WIDE_CHARS not in escargs.args.options
+  if wide_chars:
+    encoding = "utf-8"
+  else:
+    encoding = "latin-1"
+
+  def Line(first, count, columns):
+    return "".join(chr(first + i % count) for i in range(columns))
+
+  texts = [("ASCII", Line(0x21, 0x7e - 0x21, narrow).encode("ascii")),
+           ("Latin-1", Line(0xa1, 0xff - 0xa1, narrow).encode(encoding))]
+  if wide_chars:
+    # CJK ideographs, two columns each.
+    texts.append(("UTF-8 wide", Line(0x4e00, 0x5000, narrow // 2).encode("utf-8")))
+  return [(name, text + b"\r\n") for name, text in texts]
+
+def BenchThroughput():
+  """Measure how quickly the terminal processes printable text."""
+  for name, line in ThroughputTexts():
+    ClearScreen()
+    count = max(1, escargs.args.bench_bytes // len(line))
+    seconds = TimeRepeated(line, count)
+    Record(escargs.ACTION_BENCH_THROUGHPUT, name,
+           bytes=len(line) * count,
+           seconds=seconds,
+           bytes_per_second=len(line) * count / seconds)
+  ClearScreen()
+
+def Captured(command, *args):
+  """Returns the bytes which |command| would write, without sending them."""
+  escio.BeginCapture()
+  try:
+    command(*args)
+  finally:
+    data = escio.EndCapture()
+  return data
+
+def TimeRepeated(data, count):
+  """Write |data| |count| times and return the seconds the terminal took to
+  process it."""
+  data = data * count
+  start = time.time()
+  escio.Write(data)
+  WaitUntilProcessed()
+  return time.time() - start
+
+def ScrollMargins(size):
+  """Returns (name, top, bottom, left, right) for each margin configuration
+  to benchmark. Left and right margins need VT level 4."""
+  width = size.width()
+  height = size.height()
+  configurations = [("full screen", 1, height, 1, width),
+                    ("top and bottom margins", 5, height - 5, 1, width)]
+  if esc.vtLevel >= 4:
+    configurations.extend([
+        ("left and right margins", 1, height, 5, width - 5),
+        ("all margins", 5, height - 5, 5, width - 5)])
+  return configurations
+
+def BenchScroll():
+  """Measure how quickly the terminal scrolls within each margin
+  configuration, with IND and RI at the margins and with SU and SD."""
+  size = escutil.GetScreenSize()
+  for name, top, bottom, left, right in ScrollMargins(size):
+    operations = [("IND", Point(left, bottom), Captured(esccmd.IND)),
+                  ("RI", Point(left, top), Captured(esccmd.RI)),
+                  ("SU", Point(left, top), Captured(esccmd.SU, 1)),
+                  ("SD", Point(left, top), Captured(esccmd.SD, 1))]
+    for operation, position, data in operations:
+      ClearScreen()
+      FillRows(size.height())
+      if esc.vtLevel >= 4:
+        esccmd.DECSET(esccmd.DECLRMM)
+        esccmd.DECSLRM(left, right)
+      esccmd.DECSTBM(top, bottom)
+      esccmd.CUP(position)
+      count = escargs.args.bench_iterations
+      seconds = TimeRepeated(data, count)
+      Record(escargs.ACTION_BENCH_SCROLL, "%s, %s" % (operation, name),
+             operations=count,
+             seconds=seconds,
+             operations_per_second=count / seconds)
+      if esc.vtLevel >= 4:
+        esccmd.DECRESET(esccmd.DECLRMM)
+  ClearScreen()
+
+def RectangleOperations(top, left, bottom, right):
+  """Returns (name, bytes) pairs for each rectangular operation applied to
+  the given rectangle."""
+  # Copy to one row and column further in, or onto itself if it is as large
+  # as the screen.
+  size = escutil.GetScreenSize()
+  dest_top = top + (bottom < size.height())
+  dest_left = left + (right < size.width())
+  return [("DECCRA", Captured(esccmd.DECCRA, top, left, bottom, right, 1,
+                              dest_top, dest_left, 1)),
+          ("DECFRA", Captured(esccmd.DECFRA, ord("x"), top, left, bottom, right)),
+          ("DECERA", Captured(esccmd.DECERA, top, left, bottom, right)),
+          ("DECSERA", Captured(esccmd.DECSERA, top, left, bottom, right)),
+          ("DECCARA", Captured(esccmd.DECCARA, top, left, bottom, right, 7))]
+
+def BenchRectangleSizes(columns):
+  """Time each rectangular operation on squares of increasing size and on
+  the whole screen."""
+  size = escutil.GetScreenSize()
+  sizes = [(n, n) for n in (1, 4, 16) if n <= size.height()]
+  sizes.extend([(size.width() // 2, size.height() // 2),
+                (size.width(), size.height())])
+  for width, height in sizes:
+    for name, data in RectangleOperations(1, 1, height, width):
+      ClearScreen()
+      FillRows(size.height())
+      count = escargs.args.bench_iterations
+      seconds = TimeRepeated(data, count)
+      Record(escargs.ACTION_BENCH_RECT,
+             "%s, %dx%d of %d columns" % (name, width, height, columns),
+             operations=count,
+             cells=width * height,
+             seconds=seconds,
+             us_per_operation=seconds * 1e6 / count,
+             ns_per_cell=seconds * 1e9 / (count * width * height))
+
+def BenchRect():
+  """Measure DECCRA, DECFRA, DECERA, DECSERA and DECCARA on rectangles up to
+  the size of the screen, in 80 and then 132 columns."""
+  if esc.vtLevel < 4:
+    LogInfo("%s needs VT level 4; skipped" % escargs.ACTION_BENCH_RECT)
+    return
+  BenchRectangleSizes(escutil.GetScreenSize().width())
+
+  esccmd.DECSET(esccmd.Allow80To132)
+  esccmd.DECSET(esccmd.DECCOLM)
+  width = escutil.GetScreenSize().width()
+  if width == 132:
+    BenchRectangleSizes(width)
+  else:
+    LogInfo("%s: terminal did not switch to 132 columns; skipped" %
+            escargs.ACTION_BENCH_RECT)
+  esccmd.DECRESET(esccmd.DECCOLM)
+  esccmd.DECRESET(esccmd.Allow80To132)
+  ClearScreen()
+
+BENCHMARKS = {
+    escargs.ACTION_BENCH_LATENCY: BenchLatency,
+    escargs.ACTION_BENCH_THROUGHPUT: BenchThroughput,
+    escargs.ACTION_BENCH_SCROLL: BenchScroll,
+    escargs.ACTION_BENCH_RECT: BenchRect,
+}
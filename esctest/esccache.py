@@ -0,0 +1,134 @@
+'''
+A cache of test outcomes for --results-cache. Each outcome is stored under a
+key which changes whenever anything that could change it does: the source
+files of the test's class and of the classes it inherits from, esctest's own
+modules and the model used by --headless, the options which affect how tests behave, and the terminal, as
+identified by its replies to DA, DA2 and XTVERSION.
+'''
+
+import fcntl
+import glob
+import hashlib
+import inspect
+import json
+import os
+
+import escargs
+import esccmd
+import escio
+from esclog import LogDebug
+import esctypes
+
+# Options which can change the outcome of a test, including those which
+# change how the terminal is reset before it.
+KEY_OPTIONS = ("expected_terminal", "options", "max_vt_level", "force",
+               "xterm_checksum", "xterm_reverse_wrap", "hierarchical_checksum",
+               "incremental_reset", "verify_reset")
+
+gHarnessHash = None
+
+# The contents of the source files read by TestSource(), by path.
+gSourceFiles = {}
+
+def HarnessHash():
+  """Returns a hash of the esc*.py modules which the tests are built on, and
+  of the model which --headless runs them against."""
+  global gHarnessHash
+  if gHarnessHash is None:
+    h = hashlib.sha256()
+    directory = os.path.dirname(os.path.abspath(__file__))
+    paths = (sorted(glob.glob(os.path.join(directory, "esc*.py"))) +
+             sorted(glob.glob(os.path.join(directory, "model", "*.py"))))
+    for path in paths:
+      with open(path, "rb") as f:
+        h.update(f.read())
+    gHarnessHash = h.hexdigest()
+  return gHarnessHash
+
+def TestSource(method):
+  """Returns the name of a test followed by the source files of its class
+  and of the classes it inherits from. Whole files are used, since a test may
+  depend on helpers and constants anywhere in them."""
+  testClass = method.__self__
+  if not inspect.isclass(testClass):
+    testClass = type(testClass)
+  name = "%s.%s\n" % (testClass.__name__, inspect.unwrap(method).__name__)
+  paths = []
+  for cls in testClass.__mro__:
+    if cls is object:
+      continue
+    path = inspect.getsourcefile(cls)
+    if path not in paths:
+      paths.append(path)
+  parts = [name]
+  for path in paths:
+    if path not in gSourceFiles:
+      with open(path) as f:
+        gSourceFiles[path] = f.read()
+    parts.append(gSourceFiles[path])
+  return "".join(parts)
+
+def TerminalFingerprint():
+  """Returns a string identifying the terminal by its replies to DA, DA2 and
+  XTVERSION. A terminal which does not answer one of them leaves that part
+  empty."""
+  replies = []
+  for request, final, prefix in [(esccmd.DA, "c", "?"),
+                                 (esccmd.DA2, "c", ">"),
+                                 (esccmd.XTVERSION, None, None)]:
+    request()
+    try:
+      if final is None:
+        replies.append(escio.ReadDCS(sentinel=True))
+      else:
+        replies.append(";".join(map(str, escio.ReadCSI(final, prefix, sentinel=True))))
+    except esctypes.InternalError as e:
+      LogDebug("No reply for the terminal fingerprint: " + str(e))
+      replies.append("")
+  return "|".join(replies)
+
+class ResultCache(object):
+  """Outcomes of tests, kept in a JSON file."""
+  def __init__(self, path, fingerprint):
+    self._path = path
+    self._fingerprint = fingerprint
+    self._outcomes = ReadOutcomes(path)
+    self._stored = {}
+
+  def Key(self, method):
+    h = hashlib.sha256()
+    options = [repr(getattr(escargs.args, name)) for name in KEY_OPTIONS]
+    for part in [HarnessHash(), TestSource(method), "\0".join(options),
+                 self._fingerprint]:
+      h.update(part.encode("utf-8"))
+      h.update(b"\0")
+    return h.hexdigest()
+
+  def Get(self, key):
+    """Returns the stored outcome for |key|, or None."""
+    return self._outcomes.get(key)
+
+  def Store(self, key, outcome):
+    self._outcomes[key] = outcome
+    self._stored[key] = outcome
+
+  def Save(self):
+    """Write the outcomes stored by this run, keeping any other entries in
+    the file, which other runs may have added meanwhile. A lock keeps runs
+    which share the file, such as --shards workers, from saving at once, and
+    the file is replaced whole so that it is never seen half written."""
+    with open(self._path + ".lock", "w") as lock:
+      fcntl.flock(lock, fcntl.LOCK_EX)
+      outcomes = ReadOutcomes(self._path)
+      outcomes.update(self._stored)
+      temporary = "%s.%d" % (self._path, os.getpid())
+      with open(temporary, "w") as f:
+        json.dump(outcomes, f, indent=1, sort_keys=True)
+      os.replace(temporary, self._path)
+
+def ReadOutcomes(path):
+  try:
+    with open(path) as f:
+      return json.load(f)
+  except (IOError, ValueError):
+    return {}
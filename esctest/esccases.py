@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+'''
+The archive of test cases written for --test-case-dir: what each test sent to
+the terminal, kept in one file rather than a file per test.
+
+The archive is in the format of escarchive. Each record holds one test case:
+the length of the test's name, the name and what the test sent. Each run
+appends its test cases and then an index of the latest case of every test in
+the archive, so a test which runs again replaces its earlier case.
+
+To list the test cases in an archive, or write one to standard output:
+  esccases.py ARCHIVE [TEST]
+'''
+
+import os
+import struct
+import sys
+
+import escarchive
+import escoding
+import esctypes
+
+# The name of the archive within --test-case-dir.
+ARCHIVE_NAME = "test-cases.esca"
+
+MAGIC = b"ESCCAS02"
+
+CASE = 1
+
+NAME_LENGTH = struct.Struct("<H")
+
+class TestCaseArchive(object):
+  """An archive read from |path| through mmap. Get(name) returns the output
+  of a test as bytes."""
+  def __init__(self, path):
+    self._reader = escarchive.ArchiveReader(path, MAGIC)
+    # The offset and length of each test case's data, and the offset of its
+    # record, by name.
+    self._entries = {}
+    self.offsets = {}
+    for offset in self._reader.offsets:
+      kind, start, length = self._reader.Record(offset)
+      if kind != CASE:
+        continue
+      nameLength, = NAME_LENGTH.unpack(
+          self._reader.Data(start, NAME_LENGTH.size))
+      start += NAME_LENGTH.size
+      name = escoding.to_string(self._reader.Data(start, nameLength))
+      start += nameLength
+      length -= NAME_LENGTH.size + nameLength
+      self._entries[name] = (start, length)
+      self.offsets[name] = offset
+
+  def Names(self):
+    """Returns the names of the test cases, in the order they were added."""
+    return sorted(self._entries, key=lambda name: self._entries[name][0])
+
+  def __contains__(self, name):
+    return name in self._entries
+
+  def Get(self, name):
+    if name not in self._entries:
+      raise esctypes.InternalError("No test case named %s" % name)
+    return self._reader.Data(*self._entries[name])
+
+  def Close(self):
+    self._reader.Close()
+
+class TestCaseWriter(object):
+  """Appends test cases to the archive at |path|, creating it if need be,
+  and indexes all of them when closed."""
+  def __init__(self, path):
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+      os.makedirs(directory)
+    # The offset of the latest record for each test.
+    self._offsets = {}
+    if os.path.exists(path) and os.path.getsize(path) > 0:
+      archive = TestCaseArchive(path)
+      self._offsets = archive.offsets
+      archive.Close()
+    self._writer = escarchive.ArchiveWriter(path, MAGIC, append=True)
+
+  def Begin(self, name):
+    """Returns a file-like object for the output of the test |name|, which
+    is added to the archive when it is closed."""
+    return TestCaseOutput(self, name)
+
+  def Add(self, name, data):
+    binaryName = escoding.to_binary(name)
+    self._offsets[name] = self._writer.Append(
+        CASE, NAME_LENGTH.pack(len(binaryName)), binaryName, data)
+    # A run which is killed keeps the cases it finished.
+    self._writer.Flush()
+
+  def Close(self):
+    self._writer.Close(sorted(self._offsets.values()))
+
+class TestCaseOutput(object):
+  """The output of one test, collected for a TestCaseWriter."""
+  def __init__(self, writer, name):
+    self._writer = writer
+    self._name = name
+    self._data = bytearray()
+
+  def write(self, data):
+    self._data.extend(data)
+
+  def close(self):
+    self._writer.Add(self._name, bytes(self._data))
+
+def main(argv):
+  if len(argv) not in (2, 3):
+    sys.stderr.write("Usage: %s ARCHIVE [TEST]\n" % argv[0])
+    return 2
+  archive = TestCaseArchive(argv[1])
+  try:
+    if len(argv) == 2:
+      for name in archive.Names():
+        print(name)
+    else:
+      output = getattr(sys.stdout, "buffer", sys.stdout)
+      output.write(archive.Get(argv[2]))
+  finally:
+    archive.Close()
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv))
@@ -1,5 +1,3 @@
-from esc import ESC
-
 from escutil import AssertVTLevel
 from escutil import GetIndexedColors
 
@@ -133,17 +131,74 @@ QUERY_HEX = 1
 SET_UTF8 = 2
 QUERY_UTF8 = 3
 
+# The modes above, in the order escutil.GetModeSnapshot() reports them.
+ANSI_MODES = [GATM, KAM, IRM, SRTM, VEM, HEM, PUM, SRM, FEAM, FETM, MATM, TTM,
+              SATM, TSM, EBM, LNM]
+DEC_MODES = [DECCKM, DECANM, DECCOLM, DECSCLM, DECSCNM, DECOM, DECAWM, DECARM,
+             DECPFF, DECPEX, DECTCEM, DECRLM, DECHEBM, DECHEM, Allow80To132,
+             MoreFix, DECNRCM, ReverseWrapInline, ALTBUF, DECNAKB, DECHCCM,
+             DECVCCM, DECPCCM, DECNKM, DECBKM, DECKBUM, DECLRMM, DECXRLM,
+             DECKPM, DECNCSM, DECRLCM, DECCRTSM, DECARSM, DECMCM, DECAAM,
+             DECCANSM, DECNULM, DECHDPXM, DECESKM, DECOSCNM, ReverseWrapExtend,
+             OPT_ALTBUF, SaveRestoreCursor, OPT_ALTBUF_CURSOR]
+
+# Set by commands which may change the screen size, so that esctest's reset()
+# knows to measure it again.
+gScreenMayHaveResized = True
+
+# What commands have changed since the last reset, so that esctest's
+# --incremental-reset can undo just that. See Touch().
+TOUCHED_ALL = "all"  # Anything else; needs a full reset.
+TOUCHED_COLORS = "colors"
+TOUCHED_MARGINS = "margins"
+TOUCHED_MODES = "modes"
+TOUCHED_SGR = "sgr"
+TOUCHED_TABS = "tabs"
+TOUCHED_TITLE_MODES = "title modes"
+TOUCHED_TITLE_STACK = "title stack"
+gTouched = set()
+
+# Modes changed since the last reset, as (DEC, mode) pairs, and the number of
+# titles pushed since then.
+gTouchedModes = set()
+gTitlesPushed = 0
+
+# The values which modes have after a full reset. Changing any other mode
+# needs a full reset to undo.
+DEC_MODE_DEFAULTS = {
+    ALTBUF: False,
+    DECAWM: True,
+    DECCKM: False,
+    DECLRMM: False,
+    DECNCSM: False,
+    DECNKM: False,
+    DECOM: False,
+    DECSCNM: False,
+    DECTCEM: True,
+    MoreFix: False,
+    OPT_ALTBUF: False,
+    OPT_ALTBUF_CURSOR: False,
+    ReverseWrapExtend: False,
+    ReverseWrapInline: False,
+}
+ANSI_MODE_DEFAULTS = {
+    IRM: False,
+    LNM: False,
+}
+
 def SCORC():
   """Restore cursor."""
+  Touch(TOUCHED_ALL)
   escio.WriteCSI(final="u")
 
 def SCOSC():
   """Save cursor."""
+  Touch(TOUCHED_ALL)
   escio.WriteCSI(final="s")
 
 def APC():
   """Application Program Command."""
-  escio.Write(escio.APC())
+  escio.WriteC1(0x9f)
 
 def CBT(Pn=None):
   """Move cursor back by Pn tab stops or to left margin. Default is 1."""
@@ -154,6 +209,7 @@ def CBT(Pn=None):
   escio.WriteCSI(params=params, final="Z")
 
 def ChangeColor(*args):
+  Touch(TOUCHED_COLORS)
   params = [4]
   isQuery = True
   try:
@@ -164,6 +220,7 @@ def ChangeColor(*args):
   escio.WriteOSC(params, requestsReport=isQuery)
 
 def ChangeDynamicColor(*args):
+  Touch(TOUCHED_COLORS)
   params = []
   isQuery = True
   try:
@@ -174,6 +231,7 @@ def ChangeDynamicColor(*args):
   escio.WriteOSC(params, requestsReport=isQuery)
 
 def ChangeSpecialColor(*args):
+  Touch(TOUCHED_COLORS)
   if len(args) > 0 and int(args[0]) >= 10:
     params = []
   else:
@@ -194,6 +252,7 @@ def ChangeSpecialColor(*args):
   escio.WriteOSC(params, requestsReport=isQuery)
 
 def ChangeSpecialColor2(*args):
+  Touch(TOUCHED_COLORS)
   if len(args) > 0 and int(args[0]) >= 10:
     params = []
   else:
@@ -323,15 +382,21 @@ def DCH(Ps=None):
 
 def DCS():
   """Device control string. Prefixes various commands."""
-  escio.Write(escio.DCS())
+  Touch(TOUCHED_ALL)
+  escio.WriteC1(0x90)
 
 def DECALN():
   """Write test pattern."""
-  escio.Write(ESC + "#8")
+  escio.WriteESC("#8")
 
 def DECBI():
   """Index left, scrolling region right if cursor at margin."""
-  escio.Write(ESC + "6")
+  escio.WriteESC("6")
+
+def DECCARA(Pt, Pl, Pb, Pr, *args):
+  """Change the SGR attributes |args| of the characters in a rectangle."""
+  AssertVTLevel(4, "DECCARA")
+  escio.WriteCSI(params=[Pt, Pl, Pb, Pr] + list(args), intermediate="$", final="r")
 
 def DECCRA(source_top=None, source_left=None, source_bottom=None,
            source_right=None, source_page=None, dest_top=None,
@@ -359,7 +424,8 @@ def DECDHL(x):
   """Double-width, double-height line.
      x = 3: top half
      x = 4: bottom half"""
-  escio.Write(ESC + "#" + str(x))
+  Touch(TOUCHED_ALL)
+  escio.WriteESC("#" + str(x))
 
 def DECDSR(Ps, Pid=None, suppressSideChannel=False):
   """Send device status request. Does not read response."""
@@ -375,6 +441,7 @@ def DECDSR(Ps, Pid=None, suppressSideChannel=False):
 def DECELF(Pn=None):
   """Enable local functions."""
   AssertVTLevel(4, "DECELF")
+  Touch(TOUCHED_ALL)
   if Pn is not None:
     params = [Pn]
   else:
@@ -387,7 +454,7 @@ def DECERA(Pt, Pl, Pb, Pr):
 
 def DECFI():
   """Forward index."""
-  escio.Write(ESC + "9")
+  escio.WriteESC("9")
 
 def DECFRA(Pch, Pt, Pl, Pb, Pr):
   """Fill rectangle with Pch"""
@@ -403,11 +470,12 @@ def DECIC(Pn=None):
 
 def DECID():
   """Obsolete form of DA."""
-  escio.Write(escio.DECID())
+  escio.WriteC1(0x9a)
 
 def DECLFKC(Pn=None):
   """Enable local function function key control."""
   AssertVTLevel(4, "DECLFKC")
+  Touch(TOUCHED_ALL)
   if Pn is not None:
     params = [Pn]
   else:
@@ -416,7 +484,8 @@ def DECLFKC(Pn=None):
 
 def DECRC():
   """Restore the cursor and resets various attributes."""
-  escio.Write(ESC + "8")
+  Touch(TOUCHED_ALL)
+  escio.WriteESC("8")
 
 def DECRQCRA(Pid, Pp=None, rect=None):
   """Compute the checksum (16-bit sum of ordinals) in a rectangle."""
@@ -448,11 +517,15 @@ def DECRQSS(Pt):
 
 def DECRESET(Pm):
   """Reset the parameter |Pm|."""
+  if Pm == DECCOLM:
+    ScreenMayHaveResized()
+  TouchMode(Pm, True)
   escio.WriteCSI(params=[Pm], prefix='?', final='l')
 
 def DECSACE(Ps=None):
   """Set attribute change extent"""
   AssertVTLevel(4, "DECSACE")
+  Touch(TOUCHED_ALL)
   if Ps is None:
     params = []
   else:
@@ -462,6 +535,7 @@ def DECSACE(Ps=None):
 def DECSASD(Ps=None):
   """Direct output to status line if Ps is 1, to main display if 0."""
   AssertVTLevel(3, "DECSASD")
+  Touch(TOUCHED_ALL)
   if Ps is None:
     params = []
   else:
@@ -470,11 +544,13 @@ def DECSASD(Ps=None):
 
 def DECSC():
   """Saves the cursor."""
-  escio.Write(ESC + "7")
+  Touch(TOUCHED_ALL)
+  escio.WriteESC("7")
 
 def DECSCA(Ps=None):
   """Turn on character protection if Ps is 1, off if 0."""
   AssertVTLevel(2, "DECSCA")
+  Touch(TOUCHED_ALL)
   if Ps is None:
     params = []
   else:
@@ -484,6 +560,7 @@ def DECSCA(Ps=None):
 def DECSCL(level, sevenBit=None):
   """Level should be one of 61, 62, 63, or 64. sevenBit can be 0 or 1, or not
   specified."""
+  Touch(TOUCHED_ALL)
   if sevenBit is None:
     params = [level]
   else:
@@ -492,6 +569,7 @@ def DECSCL(level, sevenBit=None):
 
 def DECSCUSR(Ps=None):
   """Set cursor style 0 through 6, or default of 1."""
+  Touch(TOUCHED_ALL)
   if Ps is None:
     params = []
   else:
@@ -521,16 +599,21 @@ def DECSERA(Pt, Pl, Pb, Pr):
 
 def DECSET(Pm):
   """Set the parameter |Pm|."""
+  if Pm == DECCOLM:
+    ScreenMayHaveResized()
+  TouchMode(Pm, True)
   escio.WriteCSI(params=[Pm], prefix='?', final='h')
 
 def DECSLRM(Pl, Pr):
   """Set the left and right margins."""
   AssertVTLevel(4, "DECSLRM")
+  Touch(TOUCHED_MARGINS)
   escio.WriteCSI(params=[Pl, Pr], final='s')
 
 def DECSMKR(Pn=None):
   """Set modifier key reporting."""
   AssertVTLevel(4, "DECSMKR")
+  Touch(TOUCHED_ALL)
   if Pn is not None:
     params = [Pn]
   else:
@@ -539,6 +622,7 @@ def DECSMKR(Pn=None):
 
 def DECSNLS(Pn=None):
   """Set number of lines per screen."""
+  ScreenMayHaveResized()
   if Pn is not None:
     params = [Pn]
   else:
@@ -548,6 +632,7 @@ def DECSNLS(Pn=None):
 def DECSSDT(Pn=None):
   """Select status display type."""
   AssertVTLevel(3, "DECSSDT")
+  Touch(TOUCHED_ALL)
   if Pn is None:
     params = []
   else:
@@ -556,6 +641,7 @@ def DECSSDT(Pn=None):
 
 def DECSTBM(top=None, bottom=None):
   """Set Scrolling Region [top;bottom] (default = full size of window)."""
+  Touch(TOUCHED_MARGINS)
   params = []
   if top is not None:
     params.append(top)
@@ -566,6 +652,7 @@ def DECSTBM(top=None, bottom=None):
 
 def DECSTR():
   """Soft reset."""
+  Touch(TOUCHED_ALL)
   escio.WriteCSI(prefix='!', final='p')
 
 def DL(Pn=None):
@@ -620,7 +707,7 @@ def EL(Ps=None):
 
 def EPA():
   """End protected area."""
-  escio.Write(escio.EPA())
+  escio.WriteC1(0x97)
 
 def HPA(Pn=None):
   """Position the cursor at the Pn'th column. Default value is 1."""
@@ -641,7 +728,8 @@ def HPR(Pn=None):
 
 def HTS():
   """Set a horizontal tab stop."""
-  escio.Write(escio.HTS())
+  Touch(TOUCHED_TABS)
+  escio.WriteC1(0x88)
 
 def HVP(point=None, row=None, col=None):
   """ Move cursor to |point| """
@@ -675,7 +763,7 @@ def IL(Pn=None):
 
 def IND():
   """Move cursor down one line."""
-  escio.Write(escio.IND())
+  escio.WriteC1(0x84)
 
 def ManipulateSelectionData(Pc="", Pd=None):
   params = ["52", Pc]
@@ -685,11 +773,11 @@ def ManipulateSelectionData(Pc="", Pd=None):
 
 def NEL():
   """Index plus carriage return."""
-  escio.Write(escio.NEL())
+  escio.WriteC1(0x85)
 
 def PM():
   """Privacy message."""
-  escio.Write(escio.PM())
+  escio.WriteC1(0x9e)
 
 def REP(Ps=None):
   """Repeat the preceding character |Ps| times. Undocumented default is 1."""
@@ -700,23 +788,27 @@ def REP(Ps=None):
   escio.WriteCSI(params=params, final="b")
 
 def ResetSpecialColor(*args):
+  Touch(TOUCHED_COLORS)
   params = ["105"]
   params.extend(args)
   escio.WriteOSC(params)
 
 def ResetColor(c=""):
+  Touch(TOUCHED_COLORS)
   escio.WriteOSC(["104", c])
 
 def ResetDynamicColor(c):
+  Touch(TOUCHED_COLORS)
   escio.WriteOSC([str(c)])
 
 def RI():
   """Move cursor up one line."""
-  escio.Write(escio.RI())
+  escio.WriteC1(0x8d)
 
 def RIS():
   """Reset."""
-  escio.Write(ESC + "c")
+  ScreenMayHaveResized()
+  escio.WriteESC("c")
 
 def RM(Pm=None):
   """Reset mode."""
@@ -724,10 +816,12 @@ def RM(Pm=None):
     params = []
   else:
     params = [Pm]
+    TouchMode(Pm, False)
   escio.WriteCSI(params=params, final="l")
 
 def RM_Title(Ps1, Ps2=None):
   """Reset title mode."""
+  Touch(TOUCHED_TITLE_MODES)
   params = [Ps1]
   if Ps2 is not None:
     params.append(Ps2)
@@ -747,10 +841,12 @@ def SM(Pm=None):
     params = []
   else:
     params = [Pm]
+    TouchMode(Pm, False)
   escio.WriteCSI(params=params, final="h")
 
 def SM_Title(Ps1, Ps2=None):
   """Set title mode."""
+  Touch(TOUCHED_TITLE_MODES)
   params = [Ps1]
   if Ps2 is not None:
     params.append(Ps2)
@@ -758,19 +854,21 @@ def SM_Title(Ps1, Ps2=None):
 
 def SOS():
   """Start of string."""
-  escio.Write(escio.SOS())
+  escio.WriteC1(0x98)
 
 def SPA():
   """Start protected area."""
-  escio.Write(escio.SPA())
+  Touch(TOUCHED_ALL)
+  escio.WriteC1(0x96)
 
 def SGR(*args):
   """Select graphic rendition. Params is an array of numbers."""
+  Touch(TOUCHED_SGR)
   escio.WriteCSI(params=args, final="m")
 
 def ST():
   """String terminator."""
-  escio.Write(escio.ST())
+  escio.WriteC1(0x9c)
 
 def SU(Ps=None):
   """Scroll up by |Ps| lines. Default value is 1."""
@@ -782,6 +880,7 @@ def SU(Ps=None):
 
 def TBC(Ps=None):
   """Clear tab stop. Default arg is 0 (clear tabstop at cursor)."""
+  Touch(TOUCHED_TABS)
   if Ps is None:
     params = []
   else:
@@ -806,6 +905,7 @@ def VPR(Ps=None):
 
 def XTERM_RESTORE(Ps=None):
   """Restore given DEC private mode parameters."""
+  Touch(TOUCHED_ALL)
   if Ps is None:
     params = []
   else:
@@ -814,13 +914,19 @@ def XTERM_RESTORE(Ps=None):
 
 def XTERM_SAVE(Ps=None):
   """Save given DEC private mode parameters."""
+  Touch(TOUCHED_ALL)
   if Ps is None:
     params = []
   else:
     params = [Ps]
   escio.WriteCSI(params=params, prefix="?", final="s")
 
+def XTVERSION():
+  """Request the terminal's name and version, which is reported in a DCS."""
+  escio.WriteCSI(params=[0], prefix='>', final='q', requestsReport=True)
+
 def XTERM_WINOPS(Ps1=None, Ps2=None, Ps3=None):
+  global gTitlesPushed
   if Ps3 is not None:
     params = [Ps1, Ps2, Ps3]
   elif Ps2 is not None:
@@ -829,6 +935,9 @@ def XTERM_WINOPS(Ps1=None, Ps2=None, Ps3=None):
     params = [Ps1]
   else:
     params = []
+  if Ps1 in [WINOP_RESIZE_PIXELS, WINOP_RESIZE_CHARS, WINOP_MAXIMIZE,
+             WINOP_FULLSCREEN] or (Ps1 is not None and Ps1 >= 24):
+    ScreenMayHaveResized()
   requestsReport = Ps1 in [WINOP_REPORT_WINDOW_STATE,
                            WINOP_REPORT_WINDOW_POSITION,
                            WINOP_REPORT_WINDOW_SIZE_PIXELS,
@@ -836,8 +945,43 @@ def XTERM_WINOPS(Ps1=None, Ps2=None, Ps3=None):
                            WINOP_REPORT_SCREEN_SIZE_CHARS,
                            WINOP_REPORT_ICON_LABEL,
                            WINOP_REPORT_WINDOW_TITLE]
+  if Ps1 == WINOP_PUSH_TITLE:
+    gTitlesPushed += 1
+    Touch(TOUCHED_TITLE_STACK)
+  elif Ps1 != WINOP_POP_TITLE and not requestsReport:
+    Touch(TOUCHED_ALL)
   escio.WriteCSI(params=params, final="t", requestsReport=requestsReport)
 
+def ScreenMayHaveResized():
+  """Notes that the screen size may no longer be the one reset() measured."""
+  global gScreenMayHaveResized
+  gScreenMayHaveResized = True
+  Touch(TOUCHED_ALL)
+
+def Touch(what):
+  """Notes that |what|, one of the TOUCHED_ values, has changed since the
+  last reset."""
+  gTouched.add(what)
+
+def TouchMode(mode, DEC):
+  """Notes that a DEC private or ANSI mode has been set or reset."""
+  if DEC:
+    defaults = DEC_MODE_DEFAULTS
+  else:
+    defaults = ANSI_MODE_DEFAULTS
+  if mode in defaults:
+    gTouchedModes.add((DEC, mode))
+    Touch(TOUCHED_MODES)
+  else:
+    Touch(TOUCHED_ALL)
+
+def ClearTouched():
+  """Forget what has changed, once a reset has undone it."""
+  global gTitlesPushed
+  gTouched.clear()
+  gTouchedModes.clear()
+  gTitlesPushed = 0
+
 def ReverseWraparound():
   '''
   Return an appropriate reverse-wrap private mode.  Some tests will fail for
@@ -1,43 +1,173 @@
+import collections
 import os
+import re
 import select
 import sys
+import time
 import tty
 
+import esc
 from esc import ESC, BEL
 import escargs
-from esclog import LogDebug
+from esclog import LogDebug, LogError, LogInfo, LOG_DEBUG
 import esctypes
 import escoding
 
-stdin_fd = None
-stdout_fd = None
+# Where output goes and replies come from. See Init().
+gTransport = None
 gSideChannel = None
 use8BitControls = False
 
-def Init():
-  global stdout_fd
-  global stdin_fd
-
-  stdout_fd = os.fdopen(sys.stdout.fileno(), 'wb', 0)
-  stdin_fd = os.fdopen(sys.stdin.fileno(), 'rb', 0)
-  tty.setraw(stdin_fd)
+# Identifiers for requests such as DECRQCRA whose replies echo them back.
+gNextRequestId = 1
+
+# Replies from the terminal are read in chunks of up to this many bytes and
+# then handed out from gInputBuffer, starting at gInputPosition.
+READ_CHUNK_SIZE = 4096
+gInputBuffer = ""
+gInputPosition = 0
+
+# Round-trip times, in seconds, of the most recent replies. With
+# --adaptive-timeout, read timeouts are derived from these instead of being
+# --timeout. gRequestTime is when output was last sent to the terminal.
+LATENCY_SAMPLES = 256
+ADAPTIVE_TIMEOUT_MIN_SAMPLES = 8
+ADAPTIVE_TIMEOUT_FACTOR = 4
+ADAPTIVE_TIMEOUT_MINIMUM = 0.05
+gLatencySamples = []
+gAdaptiveTimeout = None
+gRequestTime = None
+
+# When set, reads fail once time.time() passes this value even if the
+# terminal is still sending data. See ReadResponse().
+gReadDeadline = None
+
+# Output is collected in gOutputBuffer and sent to the terminal by Flush(),
+# which happens before each read, at the end of each test, and whenever the
+# buffer grows past WRITE_BUFFER_LIMIT bytes.
+WRITE_BUFFER_LIMIT = 16384
+gOutputBuffer = bytearray()
+BEL_BYTES = escoding.to_binary(BEL)
+
+# While not None, writes are collected here instead. See BeginCapture().
+gCaptureBuffer = None
+
+# Set when Write() sends an escape sequence, C1 control or charset shift,
+# whose effect on the terminal esccmd does not know about.
+RAW_CONTROL_RE = re.compile("[\x0e\x0f\x1b\x80-\x9f]")
+RAW_CONTROL_BYTES_RE = re.compile(b"[\x0e\x0f\x1b]")
+gRawControlWritten = False
+
+# Sequences written by WriteCSI and WriteOSC, most recently used last. See
+# CachedSequence().
+SEQUENCE_CACHE_SIZE = 512
+gSequenceCache = collections.OrderedDict()
+
+class TtyTransport(object):
+  """Talks to the terminal esctest is running in, through stdout and stdin.
+
+  A transport has three methods: Write(data) sends bytes, Read(timeout)
+  returns the bytes which arrive within |timeout| seconds or raises an
+  InternalError if none do, and Close() is called when esctest is done."""
+  def __init__(self):
+    self._output = os.fdopen(sys.stdout.fileno(), 'wb', 0)
+    self._input = os.fdopen(sys.stdin.fileno(), 'rb', 0)
+    tty.setraw(self._input)
+
+  def Write(self, data):
+    while len(data) > 0:
+      # A large write to a tty may be accepted only in part.
+      n = os.write(self._output.fileno(), data)
+      data = data[n:]
+
+  def Read(self, timeout):
+    f = self._input.fileno()
+    r, w, e = select.select([f], [], [], timeout)
+    if f not in r:
+      raise esctypes.InternalError("Timeout waiting to read.")
+    data = os.read(f, READ_CHUNK_SIZE)
+    if len(data) == 0:
+      raise esctypes.InternalError("End of file while reading.")
+    return data
+
+  def Close(self):
+    tty.setcbreak(self._input)
+
+def Init(transport=None):
+  """Start talking to the terminal through |transport|, by default the
+  terminal esctest is running in."""
+  global gTransport
+  if transport is None:
+    transport = TtyTransport()
+  gTransport = transport
 
 def Shutdown():
-  tty.setcbreak(stdin_fd)
+  Flush()
+  Close()
+
+def Close():
+  """Stop talking to the terminal, dropping anything not yet sent."""
+  gTransport.Close()
 
 def Write(s, sideChannelOk=True):
+  """Write |s|, a str or bytes, to the terminal."""
+  global gRawControlWritten
+  if isinstance(s, (bytes, bytearray)):
+    if RAW_CONTROL_BYTES_RE.search(s):
+      gRawControlWritten = True
+    WriteBytes(s, sideChannelOk)
+  else:
+    if RAW_CONTROL_RE.search(s):
+      gRawControlWritten = True
+    WriteBytes(escoding.to_binary(s), sideChannelOk)
+
+def WriteESC(s):
+  """Write the escape sequence ESC |s| on behalf of esccmd, which keeps
+  track of what it does."""
+  WriteBytes(escoding.to_binary(ESC + s))
+
+def WriteBytes(data, sideChannelOk=True):
+  if gCaptureBuffer is not None:
+    gCaptureBuffer.extend(data)
+    return
   if sideChannelOk and gSideChannel is not None:
-    gSideChannel.write(escoding.to_binary(s))
-  stdout_fd.write(escoding.to_binary(s))
-
-def SetSideChannel(filename):
+    gSideChannel.write(data)
+  gOutputBuffer.extend(data)
+  if len(gOutputBuffer) >= WRITE_BUFFER_LIMIT:
+    Flush()
+
+def BeginCapture():
+  """Collect everything written from now on instead of sending it, until
+  EndCapture() is called."""
+  global gCaptureBuffer
+  gCaptureBuffer = bytearray()
+
+def EndCapture():
+  """Stop capturing output and return the bytes captured."""
+  global gCaptureBuffer
+  data = bytes(gCaptureBuffer)
+  gCaptureBuffer = None
+  return data
+
+def Flush():
+  """Send everything written so far to the terminal."""
+  global gRequestTime
+  data = bytes(gOutputBuffer)
+  del gOutputBuffer[:]
+  if len(data) > 0:
+    gRequestTime = time.time()
+    gTransport.Write(data)
+
+def SetSideChannel(channel):
+  """Copy everything written from now on to |channel|, a file-like object,
+  until called with None, which closes it."""
   global gSideChannel
-  if filename is None:
+  if channel is None:
     if gSideChannel:
       gSideChannel.close()
       gSideChannel = None
   else:
-    gSideChannel = open(filename, "wb")
+    gSideChannel = channel
 
 # Tests/conversion of C1 (8-Bit) Control Characters
 
@@ -56,6 +186,16 @@ def CmdChar(c):
     return chr(c)
   return ESC + chr(c - 0x40)
 
+# Encoded C1 controls, indexed by code - 0x80.
+C1_7BIT = [escoding.to_binary(ESC + chr(c - 0x40)) for c in range(0x80, 0xa0)]
+C1_8BIT = [escoding.to_binary(chr(c)) for c in range(0x80, 0xa0)]
+
+def CmdBytes(c):
+  """Like CmdChar, but returns bytes."""
+  if use8BitControls:
+    return C1_8BIT[c - 0x80]
+  return C1_7BIT[c - 0x80]
+
 # C1 (8-Bit) Control Characters
 
 def IND():
@@ -108,47 +248,90 @@ def APC():
 
 # I/O functions for C1 (8-Bit) Control Characters
 
+def EncodeParam(p):
+  """Returns the bytes for a parameter. None is an omitted parameter."""
+  if p is None:
+    return b""
+  if type(p) is int:
+    return b"%d" % p
+  return escoding.to_binary(str(p))
+
+def SequenceLogMessage(sequence):
+  if escargs.args.v < LOG_DEBUG:
+    return None
+  return "Send sequence: " + escoding.to_string(sequence).replace(ESC, "<ESC>")
+
+def LogSequence(sequence):
+  message = SequenceLogMessage(sequence)
+  if message is not None:
+    LogDebug(message)
+
+def WriteC1(c, sideChannelOk=True):
+  """Write the C1 control |c| in its 7- or 8-bit form."""
+  WriteBytes(CmdBytes(c), sideChannelOk)
+
 def WriteAPC(params, bel=False, requestsReport=False):
-  str_params = list(map(str, params))
   if bel:
-    terminator = BEL
+    terminator = BEL_BYTES
   else:
-    terminator = ST()
-  sequence = APC() + "".join(str_params) + terminator
-  LogDebug("Send sequence: " + sequence.replace(ESC, "<ESC>"))
-  Write(sequence, sideChannelOk=not requestsReport)
+    terminator = CmdBytes(0x9c)
+  sequence = CmdBytes(0x9f) + b"".join(map(EncodeParam, params)) + terminator
+  LogSequence(sequence)
+  WriteBytes(sequence, sideChannelOk=not requestsReport)
 
 def WriteOSC(params, bel=False, requestsReport=False):
-  str_params = list(map(str, params))
-  joined_params = ";".join(str_params)
-  if bel:
-    terminator = BEL
-  else:
-    terminator = ST()
-  sequence = OSC() + joined_params + terminator
-  LogDebug("Send sequence: " + sequence.replace(ESC, "<ESC>"))
-  Write(sequence, sideChannelOk=not requestsReport)
+  def Build():
+    if bel:
+      terminator = BEL_BYTES
+    else:
+      terminator = CmdBytes(0x9c)
+    return CmdBytes(0x9d) + b";".join(map(EncodeParam, params)) + terminator
+  key = ("OSC", use8BitControls, tuple(params), tuple(map(type, params)), bel)
+  sequence, message = CachedSequence(key, Build)
+  if message is not None:
+    LogDebug(message)
+  WriteBytes(sequence, sideChannelOk=not requestsReport)
 
 def WriteDCS(introducer, params):
-  Write(DCS() + introducer + params + ST())
+  WriteBytes(CmdBytes(0x90) + escoding.to_binary(introducer + params) + CmdBytes(0x9c))
 
 def WriteCSI(prefix="", params=[], intermediate="", final="", requestsReport=False):
   if len(final) == 0:
     raise esctypes.InternalError("final must not be empty")
-  def StringifyCSIParam(p):
-    if p is None:
-      return ""
-    return str(p)
-  str_params = list(map(StringifyCSIParam, params))
-
-  # Remove trailing empty args
-  while len(str_params) > 0 and str_params[-1] == "":
-    str_params = str_params[:-1]
-
-  joined_params = ";".join(str_params)
-  sequence = CSI() + prefix + joined_params + intermediate + final
-  LogDebug("Send sequence: " + sequence.replace(ESC, "<ESC>"))
-  Write(sequence, sideChannelOk=not requestsReport)
+  def Build():
+    encoded_params = list(map(EncodeParam, params))
+
+    # Remove trailing empty args
+    while len(encoded_params) > 0 and len(encoded_params[-1]) == 0:
+      encoded_params.pop()
+
+    return (CmdBytes(0x9b) + escoding.to_binary(prefix) +
+            b";".join(encoded_params) + escoding.to_binary(intermediate + final))
+  key = ("CSI", use8BitControls, prefix, tuple(params), tuple(map(type, params)),
+         intermediate, final)
+  sequence, message = CachedSequence(key, Build)
+  if message is not None:
+    LogDebug(message)
+  WriteBytes(sequence, sideChannelOk=not requestsReport)
+
+def CachedSequence(key, build):
+  """Returns the sequence made by calling |build|, along with its debug log
+  message (None unless debug logging is on). Results are remembered by |key|,
+  which must include everything the sequence depends on, for the
+  SEQUENCE_CACHE_SIZE most recently used keys."""
+  try:
+    entry = gSequenceCache.pop(key)
+  except TypeError:
+    # Unhashable parameters can't be cached.
+    sequence = build()
+    return sequence, SequenceLogMessage(sequence)
+  except KeyError:
+    sequence = build()
+    entry = (sequence, SequenceLogMessage(sequence))
+    if len(gSequenceCache) >= SEQUENCE_CACHE_SIZE:
+      gSequenceCache.popitem(last=False)
+  gSequenceCache[key] = entry
+  return entry
 
 def ReadOrDie(e):
   c = read(1)
@@ -158,90 +341,304 @@ def AssertCharsEqual(c, e):
   if c != e:
     raise esctypes.InternalError("Read %c (0x%02x), expected %c (0x%02x)" % (c, ord(c), e, ord(e)))
 
-def ReadOSC(expected_prefix):
-  """Read an OSC code starting with |expected_prefix|."""
-  ReadOrDie(ESC)
-  ReadOrDie(']')
-  for c in expected_prefix:
-    ReadOrDie(c)
-  s = ""
-  while not s.endswith(ST()):
-    c = read(1)
-    s += c
-  return s[:-2]
-
-def ReadCSI(expected_final, expected_prefix=None):
-  """Read a CSI code ending with |expected_final| and returns an array of parameters. """
-
+# Control sequences and strings which the terminal may send, keyed by the
+# final character of their 7-bit introducer and by their 8-bit code.
+CSI_INTRODUCERS = ("[", chr(0x9b))
+STRING_INTRODUCERS = {
+    "P": esctypes.DCSResponse,
+    "]": esctypes.OSCResponse,
+    "_": esctypes.APCResponse,
+    chr(0x90): esctypes.DCSResponse,
+    chr(0x9d): esctypes.OSCResponse,
+    chr(0x9f): esctypes.APCResponse,
+}
+STRING_TERMINATOR_RE = re.compile(ESC + r"\\|" + chr(0x9c) + "|" + BEL)
+
+def ReadResponse(deadline=None):
+  """Read the next control sequence or control string sent by the terminal.
+  Returns a CSIResponse, DCSResponse, OSCResponse or APCResponse.
+
+  If |deadline| is given, the read times out at that time.time() value
+  rather than after --timeout seconds without input."""
+  global gReadDeadline
+  gReadDeadline = deadline
+  try:
+    return ParseResponse()
+  finally:
+    gReadDeadline = None
+
+def ParseResponse():
   c = read(1)
   if c == ESC:
-    ReadOrDie('[')
-  elif ord(c) != 0x9b:
-    raise esctypes.InternalError("Read %c (0x%02x), expected CSI" % (c, ord(c)))
+    c = read(1)
+  elif not Is8BitControl(c):
+    raise esctypes.InternalError(
+        "Read %c (0x%02x), expected a control sequence" % (c, ord(c)))
+
+  if c in CSI_INTRODUCERS:
+    response = ReadCSIBody()
+  elif c in STRING_INTRODUCERS:
+    data, terminator = ReadStringBody(STRING_INTRODUCERS[c] == esctypes.OSCResponse)
+    response = STRING_INTRODUCERS[c](data, terminator)
+  else:
+    raise esctypes.InternalError("Unexpected introducer 0x%02x" % ord(c))
+  LogDebug("Read response: " + str(response).replace(ESC, "<ESC>"))
+  return response
+
+def ReadCSIBody():
+  """Parse the rest of a CSI sequence, following ECMA-48's layout of
+  parameter bytes, intermediate bytes and a final byte."""
+  param_bytes = ""
+  c = read(1)
+  while "0" <= c <= "?":
+    param_bytes += c
+    c = read(1)
+  intermediate = ""
+  while " " <= c <= "/":
+    intermediate += c
+    c = read(1)
+  if not "@" <= c <= "~":
+    raise esctypes.InternalError("Unexpected character 0x%02x in CSI" % ord(c))
 
-  params = []
-  current_param = ""
+  # A private-parameter prefix (one of "<=>?") may precede the parameters.
+  prefix = ""
+  while len(prefix) < len(param_bytes) and param_bytes[len(prefix)] in "<=>?":
+    prefix += param_bytes[len(prefix)]
 
-  c = read(1)
-  if not c.isdigit() and c != ';':
-    if c == expected_prefix:
-      c = read(1)
+  params = []
+  for p in param_bytes[len(prefix):].split(";"):
+    if p == "":
+      params.append(None)
+    elif p.isdigit():
+      params.append(int(p))
     else:
-      raise esctypes.InternalError("Unexpected character 0x%02x" % ord(c))
-
+      raise esctypes.InternalError("Unexpected parameter %s in CSI" % repr(p))
+  return esctypes.CSIResponse(prefix, params, intermediate, c)
+
+def ReadStringBody(bel):
+  """Read the data of a control string up to its string terminator, or up to
+  BEL if |bel| is true. Returns the data and the terminator."""
+  global gInputPosition
+  parts = []
   while True:
-    if c == ";":
-      params.append(int(current_param))
-      current_param = ""
-    elif '0' <= c <= '9':
-      current_param += c
-    else:
-      # Read all the final characters, asserting they match.
-      while True:
-        AssertCharsEqual(c, expected_final[0])
-        expected_final = expected_final[1:]
-        if len(expected_final) > 0:
-          c = read(1)
-        else:
-          break
-
-      if current_param == "":
-        params.append(None)
-      else:
-        params.append(int(current_param))
-      break
-    c = read(1)
+    m = STRING_TERMINATOR_RE.search(gInputBuffer, gInputPosition)
+    while m is not None and not IsStringTerminator(m.group(0), bel):
+      m = STRING_TERMINATOR_RE.search(gInputBuffer, m.end())
+    if m is not None:
+      parts.append(gInputBuffer[gInputPosition:m.start()])
+      gInputPosition = m.end()
+      return "".join(parts), m.group(0)
+
+    # Keep a trailing ESC in the buffer since it may begin the terminator.
+    end = len(gInputBuffer)
+    if gInputBuffer.endswith(ESC):
+      end -= 1
+    parts.append(gInputBuffer[gInputPosition:end])
+    gInputPosition = end
+    FillInputBuffer(ReadTimeout())
+
+def IsStringTerminator(t, bel):
+  if t == BEL:
+    return bel
+  if Is8BitControl(t):
+    return use8BitControls
+  return True
+
+def WriteSentinel(expected_final):
+  """Send a request which every terminal answers, choosing one whose reply
+  cannot be mistaken for a reply ending in |expected_final|. Returns the
+  final character of the sentinel's reply."""
+  if expected_final == "c":
+    WriteCSI(params=[6], final="n", requestsReport=True)
+    return "R"
+  WriteCSI(final="c", requestsReport=True)
+  return "c"
+
+def IsSentinelReply(response, sentinel_final):
+  return (isinstance(response, esctypes.CSIResponse) and
+          response.intermediate() == "" and
+          response.final() == sentinel_final)
+
+def ReadReply(expected_final, sentinel):
+  """Read the reply to a request. If |sentinel| is true a sentinel request is
+  sent first. Because the terminal answers requests in order, getting the
+  sentinel's reply first means that no other reply is coming, and an
+  InternalError is raised without waiting for --timeout. Otherwise the
+  sentinel's reply is read and discarded. Only use this for requests which
+  get at most one reply."""
+  if not sentinel:
+    return ReadResponse()
+  sentinel_final = WriteSentinel(expected_final)
+  response = ReadResponse()
+  if IsSentinelReply(response, sentinel_final):
+    raise esctypes.InternalError("No reply before the sentinel's reply.")
+  extra = ReadResponse()
+  while not IsSentinelReply(extra, sentinel_final):
+    LogDebug("Discarding unexpected reply: " + str(extra))
+    extra = ReadResponse()
+  return response
+
+def ReadOSC(expected_prefix, sentinel=False):
+  """Read an OSC code starting with |expected_prefix|."""
+  response = ReadReply("", sentinel)
+  if not isinstance(response, esctypes.OSCResponse):
+    raise esctypes.InternalError("Read %s, expected OSC" % str(response))
+  s = response.data()
+  if not s.startswith(expected_prefix):
+    raise esctypes.InternalError(
+        "Read OSC %s, expected prefix %s" % (repr(s), repr(expected_prefix)))
+  return s[len(expected_prefix):]
+
+def ReadCSI(expected_final, expected_prefix=None, sentinel=False):
+  """Read a CSI code ending with |expected_final| and returns an array of parameters. """
+  response = ReadReply(expected_final, sentinel)
+  if not isinstance(response, esctypes.CSIResponse):
+    raise esctypes.InternalError("Read %s, expected CSI" % str(response))
+  if response.prefix() != "" and response.prefix() != expected_prefix:
+    raise esctypes.InternalError("Unexpected prefix %s" % repr(response.prefix()))
+  final = response.intermediate() + response.final()
+  if final != expected_final:
+    raise esctypes.InternalError(
+        "Read final %s, expected %s" % (repr(final), repr(expected_final)))
+
+  params = response.params()
   LogDebug("ReadCSI parameters: " + ";".join(map(str,params)))
   return params
 
-def ReadDCS():
+def ReadDCS(sentinel=False):
   """ Read a DCS code. Returns the characters between DCS and ST. """
-  p = read(1)
-  if p == ESC:
-    ReadOrDie("P")
-    p += "P"
-  elif ord(p) == 0x90:
-    p = "<DCS>"
+  response = ReadReply("", sentinel)
+  if not isinstance(response, esctypes.DCSResponse):
+    raise esctypes.InternalError("Read %s, expected DCS" % str(response))
+  return response.data()
+
+def NextRequestId():
+  """Returns a number not used by any earlier request."""
+  global gNextRequestId
+  Pid = gNextRequestId
+  gNextRequestId += 1
+  return Pid
+
+def Resync():
+  """Discard all input left over from earlier requests, such as the replies
+  to a test that failed before reading them. Whatever has already arrived is
+  dropped, then a request whose reply can be recognized is sent and
+  everything received up to that reply is dropped too. DECRQCRA with a fresh
+  Pid is used when the VT level allows it, since its reply is unique;
+  otherwise DA1 is used, which cannot be told apart from a DA1 reply left
+  over from an earlier request. iTerm2 does not echo the Pid, so it always
+  gets DA1. Discarded input is logged."""
+  global gInputPosition
+  stray = DrainInput()
+
+  if esc.vtLevel >= 4 and escargs.args.expected_terminal != "iTerm2":
+    Pid = NextRequestId()
+    WriteCSI(params=[Pid, 0, 1, 1, 1, 1], intermediate="*", final="y",
+             requestsReport=True)
+    reply = re.compile("(?:" + ESC + "P|" + chr(0x90) + ")" + str(Pid) +
+                       "!~[0-9A-Fa-f]*(?:" + ESC + r"\\|" + chr(0x9c) + ")")
   else:
-    raise esctypes.InternalError("Read %c (0x%02x), expected DCS" % (p, ord(p)))
-
-  result = ""
-  while not result.endswith(ST()):
-    c = read(1)
-    result += c
-  LogDebug("Read response: " + (p + result).replace(ESC, "<ESC>"))
-  if result.endswith(chr(0x9c)):
-    return result[:-1]
-  return result[:-2]
+    WriteCSI(final="c", requestsReport=True)
+    reply = re.compile("(?:" + ESC + r"\[|" + chr(0x9b) + r")\?[0-9;]*c")
+
+  try:
+    m = reply.search(gInputBuffer, gInputPosition)
+    while m is None:
+      FillInputBuffer(ReadTimeout())
+      m = reply.search(gInputBuffer, gInputPosition)
+    stray += gInputBuffer[gInputPosition:m.start()]
+    gInputPosition = m.end()
+  except esctypes.InternalError as e:
+    LogError("Failed to resynchronize with the terminal: " + str(e))
+  # Nothing has been sent since the sentinel, so anything after its reply is
+  # stray as well.
+  stray += DrainInput()
+  if len(stray) > 0:
+    LogInfo("Discarded stray input: " + repr(stray))
+
+def DrainInput():
+  """Empty the input buffer, along with any input which is available without
+  waiting. Returns what was removed."""
+  global gInputBuffer
+  global gInputPosition
+  try:
+    while True:
+      FillInputBuffer(0)
+  except esctypes.InternalError:
+    pass
+  drained = gInputBuffer[gInputPosition:]
+  gInputBuffer = ""
+  gInputPosition = 0
+  return drained
+
+def FillInputBuffer(timeout):
+  """Wait up to |timeout| seconds for input, then move everything the terminal
+  has sent so far into the input buffer with a single read."""
+  global gInputBuffer
+  global gInputPosition
+  global gRequestTime
+  Flush()
+  data = gTransport.Read(timeout)
+  if gRequestTime is not None and timeout > 0:
+    AddLatencySample(time.time() - gRequestTime)
+    gRequestTime = None
+  # Drop the bytes which have already been consumed.
+  gInputBuffer = gInputBuffer[gInputPosition:] + escoding.to_string(data)
+  gInputPosition = 0
+
+def AddLatencySample(seconds):
+  global gAdaptiveTimeout
+  gLatencySamples.append(seconds)
+  if len(gLatencySamples) > LATENCY_SAMPLES:
+    del gLatencySamples[0]
+  gAdaptiveTimeout = None
+
+def Percentile(samples, percent):
+  """Returns the nearest-rank |percent|th percentile of sorted |samples|."""
+  index = int(len(samples) * percent / 100.0 + 0.5) - 1
+  return samples[max(0, min(index, len(samples) - 1))]
+
+def LatencyPercentile(percent):
+  """Returns the given percentile of the recent round-trip times."""
+  return Percentile(sorted(gLatencySamples), percent)
+
+def MeasureLatency(count=16):
+  """Time |count| CPR round trips to seed the latency estimate."""
+  for _ in range(count):
+    WriteCSI(params=[6], final="n", requestsReport=True)
+    ReadCSI("R")
+  LogInfo("Round-trip latency: p50 %.1f ms, p99 %.1f ms" % (
+      LatencyPercentile(50) * 1000, LatencyPercentile(99) * 1000))
+
+def AdaptiveTimeout():
+  """Returns a timeout a few times larger than nearly all recent round trips,
+  but no larger than --timeout."""
+  global gAdaptiveTimeout
+  if len(gLatencySamples) < ADAPTIVE_TIMEOUT_MIN_SAMPLES:
+    return escargs.args.timeout
+  if gAdaptiveTimeout is None:
+    gAdaptiveTimeout = min(escargs.args.timeout,
+                           max(ADAPTIVE_TIMEOUT_MINIMUM,
+                               ADAPTIVE_TIMEOUT_FACTOR * LatencyPercentile(99)))
+    LogDebug("Adaptive timeout is %.3f s" % gAdaptiveTimeout)
+  return gAdaptiveTimeout
+
+def ReadTimeout():
+  """Returns the number of seconds to wait for more input."""
+  if escargs.args.adaptive_timeout:
+    timeout = AdaptiveTimeout()
+  else:
+    timeout = escargs.args.timeout
+  if gReadDeadline is not None:
+    timeout = max(0, min(timeout, gReadDeadline - time.time()))
+  return timeout
 
 def read(n):
-  """Try to read n bytes. Times out if it takes more than 1
-  second to read any given byte."""
-  s = ""
-  f = sys.stdin.fileno()
-  for _ in range(n):
-    r, w, e = select.select([f], [], [], escargs.args.timeout)
-    if f not in r:
-      raise esctypes.InternalError("Timeout waiting to read.")
-    s += escoding.to_string(os.read(f, 1))
+  """Try to read n bytes. Times out if it takes more than --timeout
+  seconds for any more of them to arrive."""
+  global gInputPosition
+  while len(gInputBuffer) - gInputPosition < n:
+    FillInputBuffer(ReadTimeout())
+  s = gInputBuffer[gInputPosition:gInputPosition + n]
+  gInputPosition += n
   return s
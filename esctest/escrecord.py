@@ -0,0 +1,170 @@
+'''
+Records what esctest sends to the terminal and what it gets back, for
+--record, and plays a recording back in place of the terminal, for --replay.
+
+A recording is in the format of escarchive. Its header gives the time the run
+began. Each record holds the time in seconds since recording began followed
+by data, which depends on its kind:
+  WRITE    bytes sent to the terminal
+  READ     bytes received from it
+  TIMEOUT  a read which found nothing; the data is the error message
+  MARK     the name of the test which starts here
+The index lists every record.
+'''
+
+import struct
+import time
+
+import escarchive
+import escoding
+import esctypes
+
+MAGIC = b"ESCREC02"
+
+WRITE = 1
+READ = 2
+TIMEOUT = 3
+MARK = 4
+KIND_NAMES = {WRITE: "write", READ: "read", TIMEOUT: "timeout", MARK: "test"}
+
+# The header holds the time the run began, which tests use to make unique
+# strings; each record starts with a time since recording began.
+TIME = struct.Struct("<d")
+
+class RecordingTransport(object):
+  """An escio transport which passes everything to and from |transport|,
+  writing it to a recording at |path| of a run which began at |start|."""
+  def __init__(self, transport, path, start):
+    self._transport = transport
+    self._writer = escarchive.ArchiveWriter(path, MAGIC, TIME.pack(start))
+    self._offsets = []
+    self._start = time.time()
+
+  def Append(self, kind, data):
+    self._offsets.append(self._writer.Append(
+        kind, TIME.pack(time.time() - self._start), data))
+
+  def Mark(self, name):
+    """Note that the test |name| starts here."""
+    self.Append(MARK, escoding.to_binary(name))
+
+  def Write(self, data):
+    self.Append(WRITE, data)
+    self._transport.Write(data)
+
+  def Read(self, timeout):
+    try:
+      data = self._transport.Read(timeout)
+    except esctypes.InternalError as e:
+      self.Append(TIMEOUT, escoding.to_binary(str(e)))
+      raise
+    self.Append(READ, data)
+    return data
+
+  def Close(self):
+    self._transport.Close()
+    self._writer.Close(self._offsets)
+
+class Recording(object):
+  """A recording read from |path|. Record(i) returns the kind, time and data
+  of record |i|; |start| is when the recorded run began."""
+  def __init__(self, path):
+    self._reader = escarchive.ArchiveReader(path, MAGIC, TIME.size)
+    self.start, = TIME.unpack(self._reader.header)
+
+  def __len__(self):
+    return len(self._reader.offsets)
+
+  def Record(self, i):
+    kind, start, length = self._reader.Record(self._reader.offsets[i])
+    when, = TIME.unpack(self._reader.Data(start, TIME.size))
+    return kind, when, self._reader.Data(start + TIME.size,
+                                         length - TIME.size)
+
+class ReplayTransport(object):
+  """An escio transport which plays back the replies in the recording at
+  |path| instead of talking to a terminal. What esctest sends must match
+  what was recorded; at the first difference, ReplayDivergence is raised,
+  kept in |divergence| and raised again by anything done afterwards, so
+  that the run cannot carry on with replies which no longer fit."""
+  def __init__(self, path):
+    self._recording = Recording(path)
+    self.start = self._recording.start
+    self._next = 0
+    # What is left to match of the current write record.
+    self._pending = b""
+    self._test = None
+    self.divergence = None
+
+  def NextRecord(self):
+    if self._next >= len(self._recording):
+      return None, None, b""
+    kind, when, data = self._recording.Record(self._next)
+    self._next += 1
+    return kind, when, data
+
+  def Diverge(self, what):
+    where = "record %d" % self._next
+    if self._test is not None:
+      where += " (in %s)" % self._test
+    self.divergence = esctypes.ReplayDivergence(
+        "Replay diverged at %s: %s" % (where, what))
+    raise self.divergence
+
+  def CheckDiverged(self):
+    if self.divergence is not None:
+      raise self.divergence
+
+  def CheckNothingPending(self, doing):
+    if self._pending:
+      self.Diverge("%s before sending the rest of a recorded write, %s" % (
+          doing, Describe(self._pending)))
+
+  def Mark(self, name):
+    self.CheckDiverged()
+    self.CheckNothingPending("test %s started" % name)
+    kind, when, data = self.NextRecord()
+    if kind != MARK or data != escoding.to_binary(name):
+      self.Diverge("test %s started, but the recording has %s" % (
+          name, DescribeRecord(kind, data)))
+    self._test = name
+
+  def Write(self, data):
+    self.CheckDiverged()
+    while len(data) > 0:
+      if not self._pending:
+        kind, when, recorded = self.NextRecord()
+        if kind != WRITE:
+          self.Diverge("sent %s, but the recording has %s" % (
+              Describe(data), DescribeRecord(kind, recorded)))
+        self._pending = recorded
+      n = min(len(data), len(self._pending))
+      if data[:n] != self._pending[:n]:
+        self.Diverge("sent %s, but the recording sends %s" % (
+            Describe(data), Describe(self._pending)))
+      data = data[n:]
+      self._pending = self._pending[n:]
+
+  def Read(self, timeout):
+    self.CheckDiverged()
+    self.CheckNothingPending("read")
+    kind, when, data = self.NextRecord()
+    if kind == READ:
+      return data
+    if kind == TIMEOUT:
+      raise esctypes.InternalError(escoding.to_string(data))
+    self.Diverge("read, but the recording has %s" % DescribeRecord(kind, data))
+
+  def Close(self):
+    pass
+
+def Describe(data):
+  # Long writes are mostly the same reset sequence; the start is enough.
+  if len(data) > 80:
+    return repr(escoding.to_string(data[:80])) + "..."
+  return repr(escoding.to_string(data))
+
+def DescribeRecord(kind, data):
+  if kind is None:
+    return "ended"
+  return "a %s of %s" % (KIND_NAMES[kind], Describe(data))
@@ -0,0 +1,181 @@
+'''
+Runs tests in several terminals at once. The driver does not talk to a
+terminal itself: it starts --shards instances of --terminal-command, each
+running esctest as a worker on its share of the tests, and merges the results
+the workers write to --results-file.
+
+Tests are handed out longest first, using the durations recorded in
+--durations-file by earlier runs, to whichever terminal has the least work so
+far. Tests which need the window manager all go to the same terminal.
+'''
+
+import heapq
+import json
+import os
+import re
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import escargs
+from esclog import LogInfo, LogError
+
+# Outcomes of a test, as recorded in a results file.
+PASSED = "passed"
+FAILED = "failed"
+KNOWN_BUG = "known bug"
+
+# Options which only the driver uses; they are not passed to the workers.
+# --window-id names the driver's window, not any of the workers'.
+DRIVER_OPTIONS = ("--shards", "--terminal-command", "--durations-file",
+                  "--window-id")
+
+# Tests which iconify, move or resize the window. Running them in several
+# terminals on one display at once would let them disturb each other.
+WINDOW_MANAGER_TESTS = re.compile(r"XtermWinopsTests\.")
+
+# Assumed duration in seconds of each test when there is no history.
+DEFAULT_DURATION = 1.0
+
+def IsDriverOption(name):
+  """Whether |name| is one of DRIVER_OPTIONS, or an abbreviation of one, as
+  argparse accepts."""
+  if not name.startswith("--") or len(name) <= 2:
+    return False
+  for option in DRIVER_OPTIONS:
+    if option.startswith(name):
+      return True
+  return False
+
+def WorkerArguments(argv):
+  """Returns the command-line arguments |argv| without the driver's own
+  options."""
+  args = []
+  skip = False
+  for arg in argv:
+    if skip:
+      skip = False
+    elif IsDriverOption(arg):
+      skip = True
+    elif not IsDriverOption(arg.split("=")[0]):
+      args.append(arg)
+  return args
+
+def AssignShards(names, count, durations):
+  """Returns a list of |count| lists which together hold |names|, balanced
+  by the expected duration of each test. |durations| maps test names to
+  seconds; tests without one are assumed to take the median time."""
+  known = sorted([durations[name] for name in names if name in durations])
+  if len(known) > 0:
+    default = known[len(known) // 2]
+  else:
+    default = DEFAULT_DURATION
+
+  def Duration(name):
+    return durations.get(name, default)
+
+  shards = [[] for _ in range(count)]
+  shards[0] = [name for name in names if WINDOW_MANAGER_TESTS.match(name)]
+  loads = [(sum(map(Duration, shards[0])), 0)]
+  loads.extend([(0.0, i) for i in range(1, count)])
+  heapq.heapify(loads)
+  others = [name for name in names if not WINDOW_MANAGER_TESTS.match(name)]
+  for name in sorted(others, key=Duration, reverse=True):
+    load, i = heapq.heappop(loads)
+    shards[i].append(name)
+    heapq.heappush(loads, (load + Duration(name), i))
+  return shards
+
+def ReadTestList(path):
+  with open(path) as f:
+    return [line.strip() for line in f if line.strip()]
+
+def WriteTestList(path, names):
+  with open(path, "w") as f:
+    f.write("".join(name + "\n" for name in names))
+
+def ReadResults(path):
+  """Returns the dicts of test name to outcome and to duration in seconds
+  which a worker wrote."""
+  with open(path) as f:
+    contents = json.load(f)
+  return contents["results"], contents["durations"]
+
+def WriteResults(path, results, durations):
+  with open(path, "w") as f:
+    json.dump({"results": results, "durations": durations}, f,
+              indent=1, sort_keys=True)
+
+def ReadDurations(path):
+  """Returns the dict of test name to duration in seconds kept in |path|, or
+  an empty one if there is no such file yet."""
+  try:
+    with open(path) as f:
+      return json.load(f)
+  except (IOError, ValueError):
+    return {}
+
+def UpdateDurations(path, durations):
+  """Records the latest |durations| in |path|, keeping those of other
+  tests."""
+  history = ReadDurations(path)
+  history.update(durations)
+  with open(path, "w") as f:
+    json.dump(history, f, indent=1, sort_keys=True)
+
+def RunShards(names):
+  """Runs the tests in |names| in --shards terminals and returns a dict of
+  test name to outcome. Tests whose worker wrote no results count as
+  failed."""
+  if escargs.args.durations_file:
+    history = ReadDurations(escargs.args.durations_file)
+  else:
+    history = {}
+  shards = [shard for shard in AssignShards(names, escargs.args.shards, history)
+            if len(shard) > 0]
+  directory = tempfile.mkdtemp(prefix="esctest")
+  try:
+    workers = []
+    for i, shard in enumerate(shards):
+      test_list = os.path.join(directory, "tests.%d" % i)
+      results_file = os.path.join(directory, "results.%d" % i)
+      logfile = "%s.%d" % (escargs.args.logfile, i)
+      WriteTestList(test_list, shard)
+      command = (shlex.split(escargs.args.terminal_command) +
+                 [sys.executable, os.path.abspath(sys.argv[0])] +
+                 WorkerArguments(sys.argv[1:]) +
+                 ["--test-list", test_list,
+                  "--results-file", results_file,
+                  "--logfile", logfile,
+                  # Whatever got past WorkerArguments, a worker must not
+                  # start terminals of its own.
+                  "--shards=0"])
+      if escargs.args.record:
+        # Each terminal gets a recording of its own.
+        command += ["--record", "%s.%d" % (escargs.args.record, i)]
+      if escargs.args.test_case_dir:
+        command += ["--test-case-dir",
+                    os.path.join(escargs.args.test_case_dir, "shard%d" % i)]
+      LogInfo("Shard %d: %d tests, logging to %s" % (i, len(shard), logfile))
+      workers.append((subprocess.Popen(command), shard, results_file))
+
+    results = {}
+    durations = {}
+    for i, (process, shard, results_file) in enumerate(workers):
+      process.wait()
+      try:
+        shard_results, shard_durations = ReadResults(results_file)
+        results.update(shard_results)
+        durations.update(shard_durations)
+      except (IOError, ValueError, KeyError) as e:
+        LogError("Shard %d wrote no results: %s" % (i, str(e)))
+      for name in shard:
+        results.setdefault(name, FAILED)
+
+    if escargs.args.durations_file:
+      UpdateDurations(escargs.args.durations_file, durations)
+    return results
+  finally:
+    shutil.rmtree(directory)
@@ -3,20 +3,51 @@
 import inspect
 import os
 import re
+import sys
+import time
 import traceback
 
 import esc
 import escargs
+import escbench
+import esccases
+import escrecord
+import esccache
 import esccmd
 import escio
 import esclog
+import escshard
 import esctypes
 import escutil
+import model
 import tests
 import xwininfo
 
 log = None
 
+# Screen width measured by the last reset(), or None if it must be measured
+# again, and the reset sequences built by CapturedSequence().
+gResetWidth = None
+gResetSequences = {}
+
+# With --verify-reset, the modes after the first reset and after the latest
+# one, and the name of the test which ran last.
+gGoldenModes = None
+gLastModes = None
+gPreviousTest = None
+
+# With --differential, the transport which compares the terminal with the
+# model.
+gDifferential = None
+
+# With --record, the transport which writes the recording, and with
+# --replay, the one which plays it back.
+gRecording = None
+gReplay = None
+
+# With --test-case-dir, the archive of what each test sent.
+gTestCases = None
+
 def init():
   '''Initialize ESC-tester'''
 
@@ -27,21 +58,163 @@ def init():
   global log
   log = ""
 
-  xwininfo.read_info(escargs.args.window_id)
-
   esc.vtLevel = escargs.args.max_vt_level
-
-  escio.Init()
+  if escargs.args.shards > 0 and escargs.args.action != escargs.ACTION_RUN:
+    parser.error("--shards only applies to --action=run")
+  if escargs.args.shards > 0:
+    # The workers talk to the terminals.
+    return
+
+  global gDifferential
+  global gRecording
+  global gReplay
+  global gTestCases
+  if escargs.args.headless:
+    transport = model.ModelTransport(HeadlessTerminal())
+  elif escargs.args.replay:
+    gReplay = escrecord.ReplayTransport(escargs.args.replay)
+    transport = gReplay
+    escutil.gUniqueStart = gReplay.start
+  else:
+    xwininfo.read_info(escargs.args.window_id)
+    transport = escio.TtyTransport()
+    if escargs.args.differential:
+      gDifferential = model.DifferentialTransport(transport,
+                                                  HeadlessTerminal())
+      transport = gDifferential
+  if escargs.args.record:
+    gRecording = escrecord.RecordingTransport(transport, escargs.args.record,
+                                              escutil.gUniqueStart)
+    transport = gRecording
+  escio.Init(transport)
+  if escargs.args.test_case_dir:
+    gTestCases = esccases.TestCaseWriter(
+        os.path.join(escargs.args.test_case_dir, esccases.ARCHIVE_NAME))
+  if escargs.args.adaptive_timeout:
+    escio.MeasureLatency()
+
+def HeadlessTerminal():
+  '''Returns the model which --headless runs the tests against. Its
+  checksums follow --expected-terminal and --xterm-checksum, its reverse
+  wraparound follows --xterm-reverse-wrap, and its C1 controls and window
+  operations follow --options.'''
+  options = escargs.args.options or []
+  if escargs.args.expected_terminal == "xterm":
+    negate = escargs.args.xterm_checksum < 279
+    if 279 <= escargs.args.xterm_checksum < 334:
+      emptyChecksum = 0
+    else:
+      emptyChecksum = 32
+  else:
+    negate = False
+    emptyChecksum = 0
+  return model.Terminal(vtLevel=escargs.args.max_vt_level,
+                        c1=(escargs.DISABLE_WIDE_CHARS in options or
+                            escargs.ALLOW_C2_CONTROLS in options),
+                        windowOps=escargs.XTERM_WINOPS_ENABLED in options,
+                        negateChecksum=negate,
+                        emptyChecksum=emptyChecksum,
+                        reverseWrapInline=(
+                            escargs.args.xterm_reverse_wrap >= 383))
 
 def shutdown():
   '''Turn off terminal modes used for testing.'''
-  escio.Shutdown()
+  if ReplayDiverged():
+    # Nothing more can be sent, but a --record recording is still finished.
+    escio.Close()
+  else:
+    escio.Shutdown()
+  if gTestCases is not None:
+    gTestCases.Close()
 
 def reset():
-  '''Reset terminal to known state, at the beginning of each unit test.'''
-  esccmd.DECSCL(60 + esc.vtLevel, 1)
+  '''Reset terminal to known state, at the beginning of each unit test.
 
+  The reset sequence is built once per VT level and screen width and then
+  sent with a single write.  The width is measured again only when a command
+  that may have resized the screen has been sent since the last reset.
+
+  With --incremental-reset, only the state which esccmd noted as changed is
+  put back, unless that is something only a full reset can undo.'''
+  global gResetWidth
   escio.use8BitControls = False
+  if esccmd.gScreenMayHaveResized:
+    gResetWidth = None
+
+  if (escargs.args.incremental_reset and gResetWidth is not None and
+      esccmd.TOUCHED_ALL not in esccmd.gTouched and
+      not escio.gRawControlWritten):
+    ResetIncrementally(gResetWidth)
+  elif gResetWidth is None:
+    escio.Write(CapturedSequence((esc.vtLevel,), ResetModes))
+    escio.Resync()
+    gResetWidth = escutil.GetScreenSize().width()
+    esccmd.gScreenMayHaveResized = False
+    escio.Write(CapturedSequence((esc.vtLevel, gResetWidth),
+                                 ResetTabStopsAndColors, gResetWidth))
+  else:
+    escio.Write(CapturedSequence((esc.vtLevel,), ResetModes) +
+                CapturedSequence((esc.vtLevel, gResetWidth),
+                                 ResetTabStopsAndColors, gResetWidth))
+    # Throw away replies left unread by the previous test. This comes after
+    # DECSCL so that the terminal is back at its normal VT level and sends
+    # 7-bit controls.
+    escio.Resync()
+  esccmd.ClearTouched()
+  escio.gRawControlWritten = False
+
+def ResetIncrementally(width):
+  '''Undo just the changes esccmd noted since the last reset.'''
+  # Take copies, since the commands below are noted too.
+  touched = set(esccmd.gTouched)
+  modes = sorted(esccmd.gTouchedModes)
+  titles = esccmd.gTitlesPushed
+  if esccmd.TOUCHED_SGR in touched:
+    esccmd.SGR(0)
+  if esccmd.TOUCHED_MARGINS in touched:
+    esccmd.DECSTBM()
+    if esc.vtLevel >= 4:
+      esccmd.DECSET(esccmd.DECLRMM)
+      esccmd.DECSLRM(1, width)
+      esccmd.DECRESET(esccmd.DECLRMM)
+  for dec, mode in modes:
+    if dec and esccmd.DEC_MODE_DEFAULTS[mode]:
+      esccmd.DECSET(mode)
+    elif dec:
+      esccmd.DECRESET(mode)
+    elif esccmd.ANSI_MODE_DEFAULTS[mode]:
+      esccmd.SM(mode)
+    else:
+      esccmd.RM(mode)
+  if esccmd.TOUCHED_TITLE_MODES in touched:
+    esccmd.RM_Title(0, 1)
+    esccmd.SM_Title(2, 3)
+  for _ in range(titles):
+    esccmd.XTERM_WINOPS(esccmd.WINOP_POP_TITLE,
+                        esccmd.WINOP_PUSH_TITLE_ICON_AND_WINDOW)
+  if esccmd.TOUCHED_TABS in touched:
+    esccmd.TBC(3)
+    SetDefaultTabStops(width)
+  if esccmd.TOUCHED_COLORS in touched:
+    ResetColors()
+  esccmd.ED(2)
+  esccmd.CUP(esctypes.Point(1, 1))
+  escio.Resync()
+
+def CapturedSequence(key, commands, *args):
+  '''Returns the bytes written by calling |commands| with |args|, which are
+  remembered under |key| rather than being written to the terminal.'''
+  if key not in gResetSequences:
+    escio.BeginCapture()
+    try:
+      commands(*args)
+    finally:
+      gResetSequences[key] = escio.EndCapture()
+  return gResetSequences[key]
+
+def ResetModes():
+  '''The part of the reset sequence which does not depend on screen size.'''
+  esccmd.DECSCL(60 + esc.vtLevel, 1)
   esccmd.DECSTR()
   esccmd.XTERM_WINOPS(esccmd.WINOP_RESIZE_CHARS, 25, 80)
   esccmd.DECRESET(esccmd.OPT_ALTBUF)  # Is this needed?
@@ -70,18 +243,26 @@ def reset():
     esccmd.XTERM_WINOPS(esccmd.WINOP_POP_TITLE,
                         esccmd.WINOP_PUSH_TITLE_ICON_AND_WINDOW)
 
-  # Clear tab stops and reset them at 1, 9, ...
+  # Clear tab stops; ResetTabStopsAndColors() sets them again.
   esccmd.TBC(3)
-  width = escutil.GetScreenSize().width()
+
+def ResetTabStopsAndColors(width):
+  '''The part of the reset sequence which depends on the screen width.'''
+  SetDefaultTabStops(width)
+  esccmd.CUP(esctypes.Point(1, 1))
+  esccmd.XTERM_WINOPS(esccmd.WINOP_DEICONIFY)
+  ResetColors()
+
+def SetDefaultTabStops(width):
+  '''Set tab stops at 1, 9, ... Moves the cursor.'''
   x = 1
   while x <= width:
     esccmd.CUP(esctypes.Point(x, 1))
     esccmd.HTS()
     x += 8
 
-  esccmd.CUP(esctypes.Point(1, 1))
-  esccmd.XTERM_WINOPS(esccmd.WINOP_DEICONIFY)
-  # Reset all colors.
+def ResetColors():
+  '''Reset all colors.'''
   esccmd.ResetColor()
 
   # Work around a bug in reset colors where dynamic colors do not get reset.
@@ -89,9 +270,8 @@ def reset():
   esccmd.ChangeDynamicColor("11", "#ffffff")
 
 def AttachSideChannel(name):
-  if escargs.args.test_case_dir:
-    path = os.path.join(escargs.args.test_case_dir, name + ".txt")
-    escio.SetSideChannel(path)
+  if gTestCases is not None:
+    escio.SetSideChannel(gTestCases.Begin(name))
 
 def RemoveSideChannel():
   escio.SetSideChannel(None)
@@ -103,8 +283,17 @@ def RunTest(name, method):
   '''Run one test.'''
   ok = True
   esclog.LogInfo("Run test: " + name)
+  if gRecording is not None:
+    gRecording.Mark(name)
+  if gReplay is not None:
+    gReplay.Mark(name)
   try:
     reset()
+    if escargs.args.verify_reset:
+      VerifyReset(name)
+    if gDifferential is not None:
+      # Only what the test itself does is compared.
+      gDifferential.ClearDivergence()
     AttachSideChannel(name)
     method()
     RemoveSideChannel()
@@ -119,16 +308,57 @@ def RunTest(name, method):
     esclog.LogInfo("Skipped because terminal lacks requisite capability: " +
                    str(e))
     ok = None
+  except esctypes.ReplayDivergence:
+    # Nothing after this can be played back.
+    RemoveSideChannel()
+    raise
   except Exception as e:
     RemoveSideChannel()
     tb = traceback.format_exc()
     ok = False
     esclog.LogError("*** TEST %s FAILED:" % name)
     esclog.LogError(tb)
+  if ReplayDiverged():
+    # The test caught the divergence itself; the run still stops here.
+    raise gReplay.divergence
+  escio.Flush()
+  if gDifferential is not None and gDifferential.divergence is not None:
+    message = "First difference from the model: " + gDifferential.divergence
+    if ok is False:
+      esclog.LogError(message)
+    else:
+      esclog.LogInfo(message)
   esclog.LogInfo("")
   return ok
 
+def ReplayDiverged():
+  '''Whether --replay has found a difference from the recording.'''
+  return gReplay is not None and gReplay.divergence is not None
+
+def VerifyReset(name):
+  '''Compare the modes after reset() with those after the first one, and log
+  any that the previous test left changed. A difference which persists is
+  only logged once.'''
+  global gGoldenModes
+  global gLastModes
+  global gPreviousTest
+  if esc.vtLevel < 3:
+    return
+  modes = escutil.GetModeSnapshot()
+  if gGoldenModes is None:
+    gGoldenModes = modes
+  elif modes != gGoldenModes and modes != gLastModes:
+    esclog.LogError("Modes not restored by reset() after %s: %s" % (
+        gPreviousTest, ", ".join(escutil.DescribeModeSnapshotChanges(gGoldenModes, modes))))
+  gLastModes = modes
+  gPreviousTest = name
+
 def MatchingNamesAndMethods():
+  if escargs.args.test_list:
+    test_list = set(escshard.ReadTestList(escargs.args.test_list))
+  else:
+    test_list = None
+
   classes = []
   for category in [tests.tests]:
     classes.extend(category)
@@ -143,16 +373,22 @@ def MatchingNamesAndMethods():
     for name, method in members:
       full_name = testClass.__name__ + "." + name
       if (name.startswith("test_") and
-          re.search(escargs.args.include, full_name)):
+          re.search(escargs.args.include, full_name) and
+          (test_list is None or full_name in test_list)):
         yield full_name, method
       else:
         esclog.LogDebug("Skipping test %s" % full_name)
 
 def PerformAction():
-  if escargs.args.action == escargs.ACTION_RUN:
+  if escargs.args.action == escargs.ACTION_RUN and escargs.args.shards > 0:
+    RunShardedTests()
+  elif escargs.args.action == escargs.ACTION_RUN:
     RunTests()
   elif escargs.args.action == escargs.ACTION_LIST_KNOWN_BUGS:
     ListKnownBugs()
+  elif escargs.args.action in escbench.BENCHMARKS:
+    reset()
+    escbench.Run(escargs.args.action)
 
 def ListKnownBugs():
   for name, method in MatchingNamesAndMethods():
@@ -162,22 +398,56 @@ def ListKnownBugs():
 
 def RunTests():
   '''Run all unit-tests.'''
-  failed = 0
-  passed = 0
-  knownBugs = 0
-  failures = []
+  results = {}
+  durations = {}
+  cache = None
+  if escargs.args.results_cache:
+    cache = esccache.ResultCache(escargs.args.results_cache,
+                                 esccache.TerminalFingerprint())
 
   for name, method in MatchingNamesAndMethods():
+    if cache is not None:
+      key = cache.Key(method)
+      if escargs.args.reuse_results and cache.Get(key) is not None:
+        results[name] = cache.Get(key)
+        esclog.LogInfo("Reusing result of %s: %s" % (name, results[name]))
+        continue
+
+    start = time.time()
     status = RunTest(name, method)
+    durations[name] = time.time() - start
     if status is None:
-      knownBugs += 1
+      results[name] = escshard.KNOWN_BUG
     elif status:
-      passed += 1
+      results[name] = escshard.PASSED
     else:
-      failures.append(name)
-      failed += 1
-      if escargs.args.stop_on_failure:
-        break
+      results[name] = escshard.FAILED
+    if cache is not None:
+      cache.Store(key, results[name])
+    if status is False and escargs.args.stop_on_failure:
+      break
+
+  if cache is not None:
+    cache.Save()
+
+  if escargs.args.results_file:
+    escshard.WriteResults(escargs.args.results_file, results, durations)
+  if escargs.args.durations_file:
+    escshard.UpdateDurations(escargs.args.durations_file, durations)
+  LogSummary(results)
+
+def RunShardedTests():
+  '''Run all unit-tests, divided among --shards terminals.'''
+  names = [name for name, method in MatchingNamesAndMethods()]
+  LogSummary(escshard.RunShards(names))
+
+def LogSummary(results):
+  '''Log the number of tests with each outcome, and which ones failed.'''
+  outcomes = list(results.values())
+  passed = outcomes.count(escshard.PASSED)
+  knownBugs = outcomes.count(escshard.KNOWN_BUG)
+  failures = [name for name in results if results[name] == escshard.FAILED]
+  failed = len(failures)
 
   if failed > 0:
     esclog.LogInfo(
@@ -207,12 +477,24 @@ def main():
   '''Main program of ESC-tester.'''
   init()
 
+  if escargs.args.shards > 0:
+    PerformAction()
+    if not escargs.args.no_print_logs:
+      print(esclog.log)
+    return
+
   try:
     PerformAction()
+  except esctypes.ReplayDivergence as e:
+    # There is no terminal to reset.
+    print("Replay stopped:\r\n")
+    print(str(e).replace("\n", "\r\n"))
+    esclog.LogError(str(e))
   except Exception:
     tb = traceback.format_exc()
     try:
       reset()
+      escio.Flush()
     except:
       print("reset() failed with traceback:")
       print(traceback.format_exc().replace("\n", "\r\n"))
@@ -222,13 +504,18 @@ def main():
     esclog.LogError("Failed with traceback:")
     esclog.LogError(tb)
   finally:
-    if escargs.args.no_print_logs:
+    if ReplayDiverged():
+      if not escargs.args.no_print_logs:
+        print ("\r\nLogs:\r\n")
+        esclog.Print()
+    elif escargs.args.no_print_logs:
       # Hackily move the cursor to the bottom of the screen.
       esccmd.CUP(esctypes.Point(1, 1))
       esccmd.CUD(999)
     else:
       try:
         reset()
+        escio.Flush()
       except:
         print("reset() failed with traceback:")
         print(traceback.format_exc().replace("\n", "\r\n"))
@@ -237,5 +524,8 @@ def main():
       esclog.Print()
 
   shutdown()
+  if ReplayDiverged():
+    return 1
+  return 0
 
-main()
+sys.exit(main())
@@ -22,6 +22,10 @@ class InternalError(Exception):
   def __init__(self, message):
     super(InternalError, self).__init__(message)
 
+class ReplayDivergence(Exception):
+  def __init__(self, message):
+    super(ReplayDivergence, self).__init__(message)
+
 class KnownBug(Exception):
   def __init__(self, reason):
     super(KnownBug, self).__init__(reason)
@@ -36,6 +40,63 @@ class InsufficientVTLevel(Exception):
         actualLevel, minimumLevel)
     super(InsufficientVTLevel, self).__init__(reason)
 
+class CSIResponse(object):
+  """A control sequence introduced by CSI, read from the terminal."""
+  def __init__(self, prefix, params, intermediate, final):
+    self._prefix = prefix
+    self._params = params
+    self._intermediate = intermediate
+    self._final = final
+
+  def __str__(self):
+    return "CSIResponse(prefix=%s, params=%s, intermediate=%s, final=%s)" % (
+        repr(self._prefix), str(self._params), repr(self._intermediate),
+        repr(self._final))
+
+  def prefix(self):
+    """Private-parameter prefix, such as "?" or ">". Empty if not present."""
+    return self._prefix
+
+  def params(self):
+    """List of numeric parameters. Omitted parameters are None."""
+    return self._params
+
+  def intermediate(self):
+    return self._intermediate
+
+  def final(self):
+    return self._final
+
+
+class StringResponse(object):
+  """A control string (DCS, OSC or APC) read from the terminal. The data
+  excludes the introducer and the terminator."""
+  def __init__(self, data, terminator):
+    self._data = data
+    self._terminator = terminator
+
+  def __str__(self):
+    return "%s(data=%s)" % (self.__class__.__name__, repr(self._data))
+
+  def data(self):
+    return self._data
+
+  def terminator(self):
+    return self._terminator
+
+
+class DCSResponse(StringResponse):
+  pass
+
+
+class OSCResponse(StringResponse):
+  pass
+
+
+class APCResponse(StringResponse):
+  pass
+
+
 class Point(object):
   def __init__(self, x, y):
     self._x = x
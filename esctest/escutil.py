@@ -1,4 +1,5 @@
 import functools
+import time
 import traceback
 import re
 
@@ -10,7 +11,9 @@ from esclog import LogInfo, LogDebug
 import esctypes
 from esctypes import Point, Size, Rect
 
-gNextId = 1
+# Number of DECRQCRA requests in flight at once. This is kept small enough
+# that the replies fit in the pty's buffer while requests are being sent.
+DECRQCRA_PIPELINE_DEPTH = 64
 gHaveAsserted = False
 
 gCharSizePixels = Size(0, 0)
@@ -20,6 +23,11 @@ gCanQueryShellSize = -1
 
 gNumIndexedColors = -1
 
+# UniqueString() makes strings from when the run began and a count, so that a
+# --replay makes the same ones as the run which was recorded.
+gUniqueStart = time.time()
+gUniqueCount = 0
+
 KNOWN_BUG_TERMINALS = "known_bug_terminals"
 
 def Raise(e):
@@ -46,6 +54,13 @@ def AssertTrue(value, details=None):
   if value is not True:
     Raise(esctypes.TestFailure(value, True, details))
 
+def UniqueString():
+  """Returns a string which differs from any made in this run or earlier
+  ones, such as a title which a terminal cannot already have."""
+  global gUniqueCount
+  gUniqueCount += 1
+  return "%d.%d" % (gUniqueStart, gUniqueCount)
+
 def GetIconTitle():
   esccmd.XTERM_WINOPS(esccmd.WINOP_REPORT_ICON_LABEL)
   return escio.ReadOSC("L")
@@ -246,40 +261,47 @@ def AssertScreenCharsInRectEqual(rect, expected_lines):
             rect.height(),
             len(expected_lines)))
 
+  for y in range(len(expected_lines)):
+    if rect.width() != len(expected_lines[y]):
+      fmt = ("Width of rect (%d) does not match number of characters in expected line " +
+             "index %d, coordinate %d (its length is %d)")
+      raise esctypes.InternalError(
+          fmt % (rect.width(),
+                 y,
+                 rect.top() + y,
+                 len(expected_lines[y])))
+
   # Check each point individually. The dumb checksum algorithm can't distinguish
   # "ab" from "ba", so equivalence of two multiple-character rects means nothing.
+  # With --hierarchical-checksum only the cells of regions whose sums differ
+  # are read, trading that precision for fewer round trips.
+  points = list(rect.points())
+  if escargs.args.hierarchical_checksum:
+    cell_checksums = FindMismatchedCells(rect, expected_lines)
+  else:
+    checksums = GetChecksumsOfRects([Rect(left=point.x(),
+                                          top=point.y(),
+                                          right=point.x(),
+                                          bottom=point.y()) for point in points])
+    cell_checksums = dict(zip([(p.x(), p.y()) for p in points], checksums))
 
   # |actual| and |expected| will form human-readable arrays of lines
   actual = []
   expected = []
   # Additional information about mismatches.
   errorLocations = []
-  for point in rect.points():
+  for point in points:
     y = point.y() - rect.top()
     x = point.x() - rect.left()
     expected_line = expected_lines[y]
-    if rect.width() != len(expected_line):
-      fmt = ("Width of rect (%d) does not match number of characters in expected line " +
-             "index %d, coordinate %d (its length is %d)")
-      raise esctypes.InternalError(
-          fmt % (rect.width(),
-                 y,
-                 point.y(),
-                 len(expected_lines[y])))
 
     expected_checksum = ord(expected_line[x])
 
-    actual_checksum = GetChecksumOfRect(Rect(left=point.x(),
-                                             top=point.y(),
-                                             right=point.x(),
-                                             bottom=point.y()))
-    # esctest is only asking for one cell at a time, which simplifies things.
-    if escargs.args.expected_terminal == "xterm":
-      if escargs.args.xterm_checksum < 279:
-        actual_checksum = 0x10000 - actual_checksum
-        # DEC terminals trim trailing blanks
-        if expected_checksum == 0 and actual_checksum == 32:
-          actual_checksum = 0
+    if (point.x(), point.y()) in cell_checksums:
+      actual_checksum = CellChecksum(cell_checksums[(point.x(), point.y())],
+                                     expected_checksum)
+    else:
+      actual_checksum = expected_checksum
 
     if len(actual) <= y:
       actual.append("")
@@ -306,29 +328,159 @@ def AssertScreenCharsInRectEqual(rect, expected_lines):
   if len(errorLocations) > 0:
     Raise(esctypes.ChecksumException(errorLocations, actual, expected))
 
+def CellChecksum(checksum, expected_checksum):
+  """Converts the DECRQCRA checksum of a single cell to the ordinal of the
+  character in it."""
+  # esctest is only asking for one cell at a time, which simplifies things.
+  if escargs.args.expected_terminal == "xterm":
+    if escargs.args.xterm_checksum < 279:
+      checksum = 0x10000 - checksum
+      # DEC terminals trim trailing blanks
+      if expected_checksum == 0 and checksum == 32:
+        checksum = 0
+  return checksum
+
+def ExpectedChecksumsOfRect(region, rect, expected_lines):
+  """Returns the checksums which a terminal may report for |region|, a part of
+  |rect| whose contents are given by |expected_lines|. Empty cells count as
+  NUL, or as blanks where the terminal may trim them."""
+  total = 0
+  empty = 0
+  for point in region.points():
+    c = ord(expected_lines[point.y() - rect.top()][point.x() - rect.left()])
+    total += c
+    if c == 0:
+      empty += 1
+  sums = [total]
+  if escargs.args.expected_terminal == "xterm":
+    if escargs.args.xterm_checksum < 279:
+      sums = [0x10000 - total, 0x10000 - (total + 32 * empty)]
+  return [s & 0xffff for s in sums]
+
+def SplitRect(rect):
+  """Splits a rect into its rows, or a single row into two halves."""
+  if rect.height() > 1:
+    return [Rect(left=rect.left(), top=y, right=rect.right(), bottom=y)
+            for y in range(rect.top(), rect.bottom() + 1)]
+  middle = rect.left() + rect.width() // 2 - 1
+  return [Rect(left=rect.left(), top=rect.top(), right=middle, bottom=rect.top()),
+          Rect(left=middle + 1, top=rect.top(), right=rect.right(), bottom=rect.top())]
+
+def FindMismatchedCells(rect, expected_lines):
+  """Compares the checksum of |rect| with the one computed from
+  |expected_lines|, splitting it into smaller regions only where the two
+  differ. Returns a dict mapping (x, y) to the checksum of each single cell
+  that had to be read; all other cells matched."""
+  cells = {}
+  regions = [rect]
+  while len(regions) > 0:
+    split = []
+    for region, checksum in zip(regions, GetChecksumsOfRects(regions)):
+      if region.width() == 1 and region.height() == 1:
+        cells[(region.left(), region.top())] = checksum
+      elif checksum not in ExpectedChecksumsOfRect(region, rect, expected_lines):
+        split.extend(SplitRect(region))
+    regions = split
+  return cells
+
 def GetChecksumOfRect(rect):
-  global gNextId
-  Pid = gNextId
-  gNextId += 1
-  esccmd.DECRQCRA(Pid, 0, rect)
-  params = escio.ReadDCS()
-
-  str_pid = str(Pid)
-  if not params.startswith(str_pid):
-    if escargs.args.expected_terminal == "iTerm2":
-      # workaround for known bug to let screen-scraping tests work...
-      str_pid = re.sub(r'[^0-9].*$', "", params)
+  return GetChecksumsOfRects([rect])[0]
+
+def GetChecksumsOfRects(rects):
+  """Returns a list with the DECRQCRA checksum of each Rect in |rects|.
+
+  Requests are sent in batches of up to DECRQCRA_PIPELINE_DEPTH without
+  waiting for the replies in between, and replies are matched to their
+  requests by Pid so they may arrive in any order. Each batch must be
+  answered within --timeout seconds; a missing reply raises InternalError."""
+  checksums = []
+  for i in range(0, len(rects), DECRQCRA_PIPELINE_DEPTH):
+    checksums.extend(GetChecksumsOfRectsBatch(rects[i:i + DECRQCRA_PIPELINE_DEPTH]))
+  return checksums
+
+def GetChecksumsOfRectsBatch(rects):
+  pending = []
+  for rect in rects:
+    Pid = escio.NextRequestId()
+    esccmd.DECRQCRA(Pid, 0, rect)
+    pending.append(Pid)
+  order = list(pending)
+
+  checksums = {}
+  deadline = time.time() + escargs.args.timeout
+  while len(pending) > 0:
+    try:
+      response = escio.ReadResponse(deadline)
+    except esctypes.InternalError as e:
+      raise esctypes.InternalError(
+          "No DECRQCRA reply for Pid %s: %s" % (
+              ", ".join(map(str, pending)), str(e)))
+    if not isinstance(response, esctypes.DCSResponse):
+      raise esctypes.InternalError("Read %s, expected DCS" % str(response))
+    params = response.data()
+
+    str_pid = re.sub(r'[^0-9].*$', "", params)
+    if str_pid == "" or int(str_pid) not in pending:
+      if escargs.args.expected_terminal == "iTerm2":
+        # workaround for known bug to let screen-scraping tests work: assume
+        # the replies are in the order of the requests.
+        Pid = pending[0]
+      else:
+        # A duplicate, or a stale reply to an earlier request.
+        LogDebug("Ignoring DECRQCRA reply " + params)
+        continue
     else:
-      Raise(esctypes.BadResponse(params, "Prefix of " + str_pid))
-
-  i = len(str_pid)
+      Pid = int(str_pid)
+    pending.remove(Pid)
+
+    i = len(str_pid)
+
+    AssertTrue(params[i:].startswith("!~"))
+    i += 2
+
+    hex_checksum = params[i:]
+    LogDebug("GetChecksum " + str(Pid) + " = " + hex_checksum)
+    checksums[Pid] = int(hex_checksum, 16)
+  return [checksums[Pid] for Pid in order]
+
+def GetModeSnapshot():
+  """Returns a tuple with the DECRQM setting of each mode in
+  esccmd.ANSI_MODES followed by each mode in esccmd.DEC_MODES: 1 for set,
+  2 for reset, 3 or 4 for permanently set or reset, and 0 for a mode which
+  the terminal does not recognize or did not report.
+
+  All of the requests are sent before reading any reply, followed by a
+  sentinel request whose reply marks the end of the replies."""
+  AssertVTLevel(3, "DECRQM")
+  for mode in esccmd.ANSI_MODES:
+    esccmd.DECRQM(mode, DEC=False)
+  for mode in esccmd.DEC_MODES:
+    esccmd.DECRQM(mode, DEC=True)
+  sentinel_final = escio.WriteSentinel("y")
+
+  settings = {}
+  deadline = time.time() + escargs.args.timeout
+  response = escio.ReadResponse(deadline)
+  while not escio.IsSentinelReply(response, sentinel_final):
+    if (isinstance(response, esctypes.CSIResponse) and
+        response.intermediate() == "$" and response.final() == "y" and
+        len(response.params()) == 2 and None not in response.params()):
+      mode, setting = response.params()
+      settings[(response.prefix() == "?", mode)] = setting
+    else:
+      LogDebug("Ignoring reply to DECRQM: " + str(response))
+    response = escio.ReadResponse(deadline)
 
-  AssertTrue(params[i:].startswith("!~"))
-  i += 2
+  return tuple([settings.get((False, mode), 0) for mode in esccmd.ANSI_MODES] +
+               [settings.get((True, mode), 0) for mode in esccmd.DEC_MODES])
 
-  hex_checksum = params[i:]
-  LogDebug("GetChecksum " + str_pid + " = " + hex_checksum)
-  return int(hex_checksum, 16)
+def DescribeModeSnapshotChanges(before, after):
+  """Returns a list of strings describing the modes whose setting differs
+  between two results of GetModeSnapshot()."""
+  names = (["%d" % mode for mode in esccmd.ANSI_MODES] +
+           ["?%d" % mode for mode in esccmd.DEC_MODES])
+  return ["mode %s: %d -> %d" % (names[i], before[i], after[i])
+          for i in range(len(names)) if before[i] != after[i]]
 
 def vtLevel(minimum):
   """Defines the minimum VT level the terminal must be capable of to succeed."""
@@ -363,6 +515,8 @@ def optionRejects(terminal, option):
       if escargs.args.expected_terminal == terminal:
         try:
           func(self, *args, **kwargs)
+        except esctypes.ReplayDivergence:
+          raise
         except Exception:
           if not hasOption:
             # Failed despite option being unset. Re-raise.
@@ -393,6 +547,8 @@ def optionRequired(terminal, option, allowPassWithoutOption=False):
       if escargs.args.expected_terminal == terminal:
         try:
           func(self, *args, **kwargs)
+        except esctypes.ReplayDivergence:
+          raise
         except Exception:
           if hasOption:
             # Failed despite option being set. Re-raise.
@@ -436,6 +592,8 @@ def knownBug(terminal, reason, noop=False, shouldTry=True):
           raise esctypes.KnownBug(reason + " (not trying)")
         try:
           func(self, *args, **kwargs)
+        except esctypes.ReplayDivergence:
+          raise
         except Exception:
           tb = traceback.format_exc()
           lines = tb.split("\n")
@@ -0,0 +1,9 @@
+'''
+A reference terminal in pure Python. With --headless, esctest runs its tests
+against it instead of a real terminal, which needs no display and takes a
+fraction of the time, and with --differential it runs alongside a real
+terminal so that their replies can be compared. It follows xterm.
+'''
+
+from model.terminal import Terminal
+from model.transport import DifferentialTransport, ModelTransport
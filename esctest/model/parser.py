@@ -0,0 +1,182 @@
+'''
+Splits the characters sent to the model into text, controls, escape
+sequences, control sequences and control strings, following the layout of
+ECMA-48 and the state machine of DEC's VT500 series.
+'''
+
+import re
+
+ESC = "\x1b"
+CAN = "\x18"
+SUB = "\x1a"
+BEL = "\x07"
+ST_8BIT = "\x9c"
+
+# C1 controls which begin a control string, by 8-bit code and by the final
+# character of their 7-bit form.
+STRING_KINDS = {
+    "\x90": "DCS", "P": "DCS",
+    "\x98": "SOS", "X": "SOS",
+    "\x9d": "OSC", "]": "OSC",
+    "\x9e": "PM", "^": "PM",
+    "\x9f": "APC", "_": "APC",
+}
+
+# Runs of characters which are printed rather than interpreted.
+TEXT_RE = re.compile("[^\x00-\x1f\x7f-\x9f]+")
+TEXT_7BIT_RE = re.compile("[^\x00-\x1f\x7f]+")
+
+GROUND = 0
+ESCAPE = 1
+CSI = 2
+STRING = 3
+STRING_ESCAPE = 4
+
+class Parser(object):
+  """Feeds text to a handler, which must provide:
+
+    Print(text)
+    Execute(c)                  a C0 control, or a C1 control other than
+                                CSI and those which begin a control string
+    EscDispatch(intermediates, final)
+    CsiDispatch(prefix, params, intermediates, final)
+                                params is a list of ints, None for omitted
+    StringDispatch(kind, data)  kind is "DCS", "OSC", "APC", "PM" or "SOS"
+
+  A sequence may be split across calls to Feed(). If |c1| is true, the
+  characters 0x80-0x9f are C1 controls; otherwise they are printed."""
+  def __init__(self, handler, c1=True):
+    self._handler = handler
+    self.c1 = c1
+    self._state = GROUND
+    self._collected = ""
+    self._kind = None
+
+  def Feed(self, text):
+    i = 0
+    n = len(text)
+    handler = self._handler
+    while i < n:
+      if self._state == GROUND:
+        if self.c1:
+          m = TEXT_RE.match(text, i)
+        else:
+          m = TEXT_7BIT_RE.match(text, i)
+        if m is not None:
+          handler.Print(m.group(0))
+          i = m.end()
+          continue
+        self.Control(text[i])
+        i += 1
+      elif self._state == STRING:
+        # Collect everything up to the terminator in one step.
+        j = i
+        while j < n and not self.EndsString(text[j]):
+          j += 1
+        self._collected += text[i:j]
+        if j < n:
+          self.Control(text[j])
+          j += 1
+        i = j
+      else:
+        self.Control(text[i])
+        i += 1
+
+  def EndsString(self, c):
+    return (c == ESC or c == CAN or c == SUB or (self.c1 and c == ST_8BIT) or
+            (c == BEL and self._kind == "OSC"))
+
+  def Control(self, c):
+    """Handle one character outside of a run of text."""
+    state = self._state
+    if c == CAN or c == SUB:
+      self._state = GROUND
+      return
+    if c == ESC:
+      if state == STRING:
+        self._state = STRING_ESCAPE
+      else:
+        self._state = ESCAPE
+        self._collected = ""
+      return
+    if self.c1 and "\x80" <= c <= "\x9f":
+      if state == STRING and c == ST_8BIT:
+        self.DispatchString()
+      elif c == "\x9b":
+        self._state = CSI
+        self._collected = ""
+      elif c in STRING_KINDS:
+        self.BeginString(STRING_KINDS[c])
+      else:
+        self._state = GROUND
+        self._handler.Execute(c)
+      return
+
+    if state == GROUND:
+      self._handler.Execute(c)
+    elif state == ESCAPE:
+      if c < " ":
+        self._handler.Execute(c)
+      elif c <= "/":
+        self._collected += c
+      elif self._collected == "" and c == "[":
+        self._state = CSI
+      elif self._collected == "" and c in STRING_KINDS:
+        self.BeginString(STRING_KINDS[c])
+      elif self._collected == "" and c == "\\":
+        # A stray ST.
+        self._state = GROUND
+      else:
+        self._state = GROUND
+        if c != "\x7f":
+          self._handler.EscDispatch(self._collected, c)
+    elif state == CSI:
+      if c < " ":
+        self._handler.Execute(c)
+      elif "@" <= c <= "~":
+        self._state = GROUND
+        self.DispatchCSI(c)
+      elif c != "\x7f":
+        self._collected += c
+    elif state == STRING:
+      if c == BEL:
+        self.DispatchString()
+    elif state == STRING_ESCAPE:
+      if c == "\\":
+        self.DispatchString()
+      else:
+        # ESC ends the string unterminated and begins a new sequence.
+        self._state = ESCAPE
+        self._collected = ""
+        self.Control(c)
+
+  def BeginString(self, kind):
+    self._state = STRING
+    self._kind = kind
+    self._collected = ""
+
+  def DispatchString(self):
+    self._state = GROUND
+    self._handler.StringDispatch(self._kind, self._collected)
+
+  def DispatchCSI(self, final):
+    body = self._collected
+    prefix = ""
+    while len(prefix) < len(body) and body[len(prefix)] in "<=>?":
+      prefix += body[len(prefix)]
+    end = len(body)
+    while end > len(prefix) and " " <= body[end - 1] <= "/":
+      end -= 1
+    intermediates = body[end:]
+    params = []
+    digits = body[len(prefix):end]
+    if digits != "":
+      for p in digits.replace(":", ";").split(";"):
+        if p.isdigit():
+          params.append(int(p))
+        elif p == "":
+          params.append(None)
+        else:
+          # Not a valid control sequence; ignore it.
+          return
+    self._handler.CsiDispatch(prefix, params, intermediates, final)
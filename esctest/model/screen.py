@@ -0,0 +1,230 @@
+'''
+The grid of character cells kept by the model.
+
+Coordinates are 0-based and ranges are half-open: a rectangle covers columns
+left to right - 1 and rows top to bottom - 1. Each cell holds a character,
+or EMPTY where nothing has been written since it was erased, and its
+attribute bits. Each row also records whether text was wrapped from its
+end onto the row below, and whether it may hold protected cells.
+
+A row is stored as two arrays, one of code points (0 for an empty cell) and
+one of attribute bits, so that the rectangular operations, scrolling and
+erasing work on slices of rows rather than on one cell at a time.
+'''
+
+from array import array
+
+EMPTY = ""
+
+# Attribute bits. The protection bits come from DECSCA and from SPA/EPA.
+BOLD = 1 << 0
+FAINT = 1 << 1
+ITALIC = 1 << 2
+UNDERLINE = 1 << 3
+BLINK = 1 << 4
+INVERSE = 1 << 5
+INVISIBLE = 1 << 6
+CROSSED_OUT = 1 << 7
+DOUBLE_UNDERLINE = 1 << 8
+DEC_PROTECTED = 1 << 9
+ISO_PROTECTED = 1 << 10
+PROTECTED = DEC_PROTECTED | ISO_PROTECTED
+
+BLANK_CELL = (EMPTY, 0)
+
+# Type code of the row arrays; code points need more than 16 bits.
+CELL_TYPE = "I"
+
+def Cells(value, count):
+  """Returns an array of |count| cells holding |value|."""
+  return array(CELL_TYPE, [value]) * count
+
+class Screen(object):
+  """A |width| by |height| grid of cells."""
+  def __init__(self, width, height):
+    self.width = width
+    self.height = height
+    self._chars = [Cells(0, width) for _ in range(height)]
+    self._attrs = [Cells(0, width) for _ in range(height)]
+    self._wrapped = [False] * height
+    # False for rows known to hold no protected cells, so that erasing them
+    # selectively can work on slices.
+    self._protected = [False] * height
+
+  def Get(self, x, y):
+    """Returns the (character, attributes) of a cell."""
+    code = self._chars[y][x]
+    if code == 0:
+      return (EMPTY, self._attrs[y][x])
+    return (chr(code), self._attrs[y][x])
+
+  def Put(self, x, y, c, attrs):
+    self._chars[y][x] = ord(c)
+    self._attrs[y][x] = attrs
+    if attrs & PROTECTED:
+      self._protected[y] = True
+
+  def IsWrapped(self, y):
+    """Whether text was wrapped from the end of row |y| onto the next."""
+    return self._wrapped[y]
+
+  def SetWrapped(self, y, wrapped):
+    self._wrapped[y] = wrapped
+
+  def Resize(self, width, height):
+    """Change the size, keeping the cells which are still on the screen."""
+    for rows in (self._chars, self._attrs):
+      del rows[height:]
+      for row in rows:
+        if width < len(row):
+          del row[width:]
+        else:
+          row.extend(Cells(0, width - len(row)))
+      while len(rows) < height:
+        rows.append(Cells(0, width))
+    self.width = width
+    self.height = height
+    self._wrapped = [False] * height
+    self._protected = (self._protected + [False] * height)[:height]
+
+  def Fill(self, left, top, right, bottom, c, attrs, skip=0):
+    """Set the cells of a rectangle, leaving those with any of the attribute
+    bits in |skip|."""
+    code = ord(c) if c != EMPTY else 0
+    chars = Cells(code, right - left)
+    fill = Cells(attrs, right - left)
+    for y in range(top, bottom):
+      if (skip and (self._protected[y] or skip & ~PROTECTED) and
+          self.AnyAttributes(left, y, right, skip)):
+        # Only a row with protected cells is done one cell at a time.
+        rowChars = self._chars[y]
+        rowAttrs = self._attrs[y]
+        for x in range(left, right):
+          if not rowAttrs[x] & skip:
+            rowChars[x] = code
+            rowAttrs[x] = attrs
+      else:
+        self._chars[y][left:right] = chars
+        self._attrs[y][left:right] = fill
+        if left == 0 and right == self.width:
+          # Nothing protected is left in the row, unless it was just put
+          # there.
+          self._protected[y] = False
+      if attrs & PROTECTED:
+        self._protected[y] = True
+
+  def AnyAttributes(self, left, y, right, bits):
+    """Whether any cell from |left| to |right| on row |y| has any of
+    |bits|."""
+    for attrs in self._attrs[y][left:right]:
+      if attrs & bits:
+        return True
+    return False
+
+  def Erase(self, left, top, right, bottom, skip=0):
+    self.Fill(left, top, right, bottom, EMPTY, 0, skip)
+    if right == self.width:
+      for y in range(top, bottom):
+        self._wrapped[y] = False
+
+  def InsertCells(self, x, y, count, right):
+    """Shift the cells from column |x| up to |right| on row |y| right by
+    |count|, dropping those pushed past |right| and blanking the gap."""
+    count = min(count, right - x)
+    for row in (self._chars[y], self._attrs[y]):
+      row[x + count:right] = row[x:right - count]
+      row[x:x + count] = Cells(0, count)
+
+  def DeleteCells(self, x, y, count, right):
+    """Shift the cells after column |x| up to |right| on row |y| left by
+    |count|, blanking the cells left at the right."""
+    count = min(count, right - x)
+    for row in (self._chars[y], self._attrs[y]):
+      row[x:right - count] = row[x + count:right]
+      row[right - count:right] = Cells(0, count)
+
+  def ScrollUp(self, left, top, right, bottom, count):
+    """Move the rows of a rectangle up by |count|, blanking the rows left at
+    the bottom."""
+    count = min(count, bottom - top)
+    if left == 0 and right == self.width:
+      # Whole rows simply change places.
+      self.ScrollFlags(top, bottom, count)
+      for rows in (self._chars, self._attrs):
+        rows[top:bottom] = (rows[top + count:bottom] +
+                            [Cells(0, self.width) for _ in range(count)])
+      return
+    blank = Cells(0, right - left)
+    for y in range(top, bottom - count):
+      self._protected[y] = self._protected[y] or self._protected[y + count]
+    for rows in (self._chars, self._attrs):
+      for y in range(top, bottom - count):
+        rows[y][left:right] = rows[y + count][left:right]
+      for y in range(bottom - count, bottom):
+        rows[y][left:right] = blank
+
+  def ScrollDown(self, left, top, right, bottom, count):
+    """Move the rows of a rectangle down by |count|, blanking the rows left at
+    the top."""
+    count = min(count, bottom - top)
+    if left == 0 and right == self.width:
+      self.ScrollFlags(top, bottom, -count)
+      for rows in (self._chars, self._attrs):
+        rows[top:bottom] = ([Cells(0, self.width) for _ in range(count)] +
+                            rows[top:bottom - count])
+      return
+    blank = Cells(0, right - left)
+    for y in range(bottom - 1, top + count - 1, -1):
+      self._protected[y] = self._protected[y] or self._protected[y - count]
+    for rows in (self._chars, self._attrs):
+      for y in range(bottom - 1, top + count - 1, -1):
+        rows[y][left:right] = rows[y - count][left:right]
+      for y in range(top, top + count):
+        rows[y][left:right] = blank
+
+  def ScrollFlags(self, top, bottom, count):
+    """Move the flags of rows |top| to |bottom| up by |count|, or down if it
+    is negative."""
+    blank = [False] * min(abs(count), bottom - top)
+    for rowFlags in (self._wrapped, self._protected):
+      flags = rowFlags[top:bottom]
+      if count > 0:
+        flags = (flags[count:] + blank)[:bottom - top]
+      else:
+        flags = (blank + flags)[:bottom - top]
+      rowFlags[top:bottom] = flags
+
+  def Copy(self, left, top, right, bottom, x, y):
+    """Copy a rectangle so that its top left corner is at |x|, |y|. The
+    source and destination may overlap."""
+    protected = self._protected[top:bottom]
+    for i, flag in enumerate(protected):
+      self._protected[y + i] = self._protected[y + i] or flag
+    for rows in (self._chars, self._attrs):
+      # Slices are copies, so the whole source is read before any of it is
+      # overwritten.
+      cells = [rows[row][left:right] for row in range(top, bottom)]
+      for i, source in enumerate(cells):
+        rows[y + i][x:x + len(source)] = source
+
+  def ChangeAttributes(self, left, top, right, bottom, set_bits, clear_bits,
+                       toggle_bits=0):
+    """Set, clear and then toggle attribute bits in a rectangle."""
+    keep = ~clear_bits
+    for y in range(top, bottom):
+      if (set_bits | toggle_bits) & PROTECTED:
+        self._protected[y] = True
+      row = self._attrs[y]
+      row[left:right] = array(CELL_TYPE,
+                              [((attrs | set_bits) & keep) ^ toggle_bits
+                               for attrs in row[left:right]])
+
+  def Checksum(self, left, top, right, bottom, empty_value):
+    """Returns the sum of the characters in a rectangle, counting each empty
+    cell as |empty_value|."""
+    total = 0
+    for y in range(top, bottom):
+      cells = self._chars[y][left:right]
+      # An empty cell holds 0, which adds nothing to the sum by itself.
+      total += sum(cells) + cells.count(0) * empty_value
+    return total
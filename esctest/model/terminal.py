@@ -0,0 +1,1517 @@
+'''
+The model's terminal: it interprets what esctest sends as xterm does and
+produces the replies xterm would.
+'''
+
+import base64
+import binascii
+import codecs
+
+import escoding
+from model import screen
+from model.parser import Parser
+from model.screen import Screen
+
+# DEC private modes which the model implements, with their values after a
+# full reset. DECRQM reports any other mode as not recognized.
+DEC_MODE_DEFAULTS = {
+    1: False,     # DECCKM
+    2: True,      # DECANM
+    3: False,     # DECCOLM
+    4: False,     # DECSCLM
+    5: False,     # DECSCNM
+    6: False,     # DECOM
+    7: True,      # DECAWM
+    12: False,    # Blinking cursor
+    18: False,    # DECPFF
+    19: False,    # DECPEX
+    25: True,     # DECTCEM
+    35: False,    # Font-shifting functions
+    40: False,    # Allow 80 to 132 columns
+    41: False,    # more(1) fix
+    42: False,    # DECNRCM
+    45: False,    # Reverse wraparound
+    47: False,    # Alternate screen
+    66: False,    # DECNKM
+    67: False,    # DECBKM
+    69: False,    # DECLRMM
+    95: False,    # DECNCSM
+    1045: False,  # Extended reverse wraparound
+    1047: False,  # Alternate screen, cleared when leaving it
+    1048: False,  # Save cursor
+    1049: False,  # Save cursor and use a cleared alternate screen
+}
+ANSI_MODE_DEFAULTS = {
+    2: False,     # KAM
+    4: False,     # IRM
+    12: True,     # SRM
+    20: False,    # LNM
+}
+# The conformance level at which DEC private modes become available.
+DEC_MODE_LEVELS = {
+    69: 4,        # DECLRMM
+    95: 5,        # DECNCSM
+}
+# Modes which DECRQM reports as permanently reset.
+ANSI_MODES_RESET = (1, 5, 7, 10, 11, 13, 14, 15, 16, 17, 18, 19)
+DEC_MODES_RESET = (8, 60)
+
+DECCOLM = 3
+DECOM = 6
+DECAWM = 7
+ALLOW_80_TO_132 = 40
+MORE_FIX = 41
+REVERSE_WRAP = 45
+ALTBUF = 47
+DECLRMM = 69
+DECNCSM = 95
+REVERSE_WRAP_EXTEND = 1045
+OPT_ALTBUF = 1047
+SAVE_CURSOR = 1048
+OPT_ALTBUF_CURSOR = 1049
+IRM = 4
+LNM = 20
+
+# Pixel geometry reported for the window and the display it is on.
+CHAR_WIDTH = 10
+CHAR_HEIGHT = 20
+DISPLAY_WIDTH = 1920
+DISPLAY_HEIGHT = 1080
+# Extra width and height of the window frame, including its title bar.
+FRAME_WIDTH = 4
+FRAME_HEIGHT = 24
+
+TITLE_STACK_LIMIT = 10
+
+# Attribute bits set by each SGR parameter.
+SGR_ATTRIBUTES = {
+    1: screen.BOLD,
+    2: screen.FAINT,
+    3: screen.ITALIC,
+    4: screen.UNDERLINE,
+    5: screen.BLINK,
+    7: screen.INVERSE,
+    8: screen.INVISIBLE,
+    9: screen.CROSSED_OUT,
+    21: screen.DOUBLE_UNDERLINE,
+}
+# Attribute bits cleared by each SGR parameter.
+SGR_RESETS = {
+    22: screen.BOLD | screen.FAINT,
+    23: screen.ITALIC,
+    24: screen.UNDERLINE | screen.DOUBLE_UNDERLINE,
+    25: screen.BLINK,
+    27: screen.INVERSE,
+    28: screen.INVISIBLE,
+    29: screen.CROSSED_OUT,
+}
+SGR_BITS = 0
+for bit in SGR_ATTRIBUTES.values():
+  SGR_BITS |= bit
+del bit
+# Attribute bits changed by DECCARA and DECRARA, for each parameter.
+RECT_ATTRIBUTES = {1: screen.BOLD, 4: screen.UNDERLINE, 5: screen.BLINK,
+                   7: screen.INVERSE}
+
+# Number of colors in the palette, which is followed by the special colors
+# for bold, underline, blink, reverse and italic.
+NUM_COLORS = 256
+NUM_SPECIAL_COLORS = 5
+DYNAMIC_COLORS = range(10, 20)
+
+def DefaultColor(n):
+  """Returns xterm's default color |n| as 16-bit red, green and blue."""
+  if n < 16:
+    basic = [(0, 0, 0), (205, 0, 0), (0, 205, 0), (205, 205, 0),
+             (0, 0, 238), (205, 0, 205), (0, 205, 205), (229, 229, 229),
+             (127, 127, 127), (255, 0, 0), (0, 255, 0), (255, 255, 0),
+             (92, 92, 255), (255, 0, 255), (0, 255, 255), (255, 255, 255)]
+    rgb = basic[n]
+  elif n < 232:
+    levels = [0, 95, 135, 175, 215, 255]
+    n -= 16
+    rgb = (levels[n // 36], levels[n // 6 % 6], levels[n % 6])
+  elif n < NUM_COLORS:
+    gray = 8 + 10 * (n - 232)
+    rgb = (gray, gray, gray)
+  else:
+    rgb = (0, 0, 0)
+  return tuple(v * 0x101 for v in rgb)
+
+def DefaultDynamicColor(n):
+  if n == 11:
+    return (0xffff, 0xffff, 0xffff)
+  return (0, 0, 0)
+
+def ParseColor(spec):
+  """Returns the 16-bit red, green and blue of a color given as rgb:r/g/b or
+  #rgb, or None if it is neither. The device-independent forms such as
+  CIEXYZ depend on the X server's color database and are not modeled."""
+  if spec.startswith("rgb:"):
+    parts = spec[4:].split("/")
+    if len(parts) != 3 or not all(1 <= len(p) <= 4 for p in parts):
+      return None
+    try:
+      # Each component is scaled from its number of hex digits to 16 bits.
+      rgb = [int(p, 16) * 0xffff // (16 ** len(p) - 1) for p in parts]
+    except ValueError:
+      return None
+  elif spec.startswith("#") and len(spec) in (4, 7, 10, 13):
+    n = (len(spec) - 1) // 3
+    try:
+      # The digits given are the high-order ones.
+      rgb = [int(spec[1 + i * n:1 + (i + 1) * n], 16) << (16 - 4 * n)
+             for i in range(3)]
+    except ValueError:
+      return None
+  else:
+    return None
+  # Report the color as allocated on a display with 8 bits per component.
+  return tuple((v >> 8) * 0x101 for v in rgb)
+
+def FormatColor(rgb):
+  return "rgb:%04x/%04x/%04x" % rgb
+
+class SavedCursor(object):
+  """What DECSC saves."""
+  def __init__(self):
+    self.x = 0
+    self.y = 0
+    self.attrs = 0
+    self.fg = None
+    self.bg = None
+    self.origin = False
+    self.wrapNext = False
+
+class Terminal(object):
+  """A model of xterm with a |width| by |height| screen, at conformance
+  level |vtLevel|.
+
+  With |reverseWrapInline|, reverse wraparound (mode 45) only goes back
+  onto a row which wrapped, as in xterm since patch 383; mode 1045 always
+  wraps. |c1| makes the 8-bit C1 controls work, as they do when xterm is not using
+  UTF-8. |windowOps| allows the selection reports and DECNCSM, which xterm
+  leaves disabled by default. DECRQCRA reports the sum of the
+  characters in the area, each empty cell counting as |emptyChecksum|, and
+  negates it if |negateChecksum| is true, as xterm did before patch 279."""
+  def __init__(self, width=80, height=25, vtLevel=5, c1=True, windowOps=False,
+               negateChecksum=True, emptyChecksum=32, reverseWrapInline=True):
+    self.maxVTLevel = vtLevel
+    self.reverseWrapInline = reverseWrapInline
+    self.windowOps = windowOps
+    self.negateChecksum = negateChecksum
+    self.emptyChecksum = emptyChecksum
+    self._parser = Parser(self, c1)
+    if c1:
+      self._decoder = None
+    else:
+      self._decoder = codecs.getincrementaldecoder("utf-8")("replace")
+    self._replies = []
+
+    self.width = width
+    self.height = height
+    self.mainScreen = Screen(width, height)
+    self.altScreen = Screen(width, height)
+    self.displayColumns = DISPLAY_WIDTH // CHAR_WIDTH
+    self.displayRows = DISPLAY_HEIGHT // CHAR_HEIGHT
+    self.windowX = 0
+    self.windowY = 0
+    self.iconified = False
+    self.unmaximizedSize = None
+    self.iconTitle = ""
+    self.windowTitle = ""
+    self.selection = ""
+    self.x = 0
+    self.y = 0
+    self.decModes = {}
+    self.FullReset()
+
+  # Input and output.
+
+  def Feed(self, data):
+    """Process |data|, the bytes sent to the terminal."""
+    if self._decoder is None:
+      text = data.decode("latin-1")
+    else:
+      text = self._decoder.decode(data)
+    self._parser.Feed(text)
+
+  def TakeReplies(self):
+    """Returns the bytes of the replies to everything fed so far, and forgets
+    them."""
+    replies = "".join(self._replies)
+    del self._replies[:]
+    if self._decoder is None:
+      return replies.encode("latin-1")
+    return replies.encode("utf-8")
+
+  def Reply(self, s):
+    self._replies.append(s)
+
+  def C1(self, c):
+    """Returns the C1 control |c| as the terminal currently sends it."""
+    if self.eightBitReplies:
+      return chr(c)
+    return "\x1b" + chr(c - 0x40)
+
+  def ReplyCSI(self, s):
+    self.Reply(self.C1(0x9b) + s)
+
+  def ReplyDCS(self, s):
+    self.Reply(self.C1(0x90) + s + self.C1(0x9c))
+
+  def ReplyOSC(self, s):
+    self.Reply(self.C1(0x9d) + s + self.C1(0x9c))
+
+  # Resets.
+
+  def FullReset(self):
+    """RIS."""
+    if self.decModes.get(DECCOLM) and self.decModes.get(ALLOW_80_TO_132):
+      self.width = 80
+    self.vtLevel = self.maxVTLevel
+    self.eightBitReplies = False
+    self.decModes = dict(DEC_MODE_DEFAULTS)
+    if not self.windowOps:
+      del self.decModes[DECNCSM]
+    self.ansiModes = dict(ANSI_MODE_DEFAULTS)
+    self.savedDecModes = {}
+    self.Resize(self.width, self.height)
+    self.mainScreen.Erase(0, 0, self.width, self.height)
+    self.altScreen.Erase(0, 0, self.width, self.height)
+    self.screen = self.mainScreen
+    self.tabs = set(range(0, self.width, 8))
+    self.titleModes = set()
+    self.titleStack = []
+    self.colors = {}
+    self.dynamicColors = {}
+    self.cursorStyle = 1
+    self.attributeExtent = 0
+    self.statusDisplay = 0
+    self.statusLineType = 0
+    self.linesPerScreen = self.height
+    self.lastChar = None
+    self.mainSaved = SavedCursor()
+    self.altSaved = SavedCursor()
+    self.SoftReset()
+    self.x = 0
+    self.y = 0
+
+  def SoftReset(self):
+    """DECSTR."""
+    self.decModes[25] = True
+    self.decModes[DECOM] = False
+    self.decModes[REVERSE_WRAP] = False
+    self.decModes[REVERSE_WRAP_EXTEND] = False
+    self.decModes[DECLRMM] = False
+    self.decModes[1] = False
+    self.decModes[66] = False
+    self.ansiModes[IRM] = False
+    self.ansiModes[2] = False
+    self.ResetMargins()
+    self.attrs = 0
+    self.fg = None
+    self.bg = None
+    self.protection = 0
+    # Which kind of protection was selected last, as in xterm: ED, EL and
+    # ECH only respect ISO protection while it is the current kind.
+    self.protectedMode = 0
+    self.wrapNext = False
+    self.SavedCursor().__init__()
+
+  def ResetMargins(self):
+    self.top = 0
+    self.bottom = self.height - 1
+    self.left = 0
+    self.right = self.width - 1
+
+  def SavedCursor(self):
+    if self.screen is self.altScreen:
+      return self.altSaved
+    return self.mainSaved
+
+  def Resize(self, width, height):
+    width = max(1, width)
+    height = max(1, height)
+    self.width = width
+    self.height = height
+    self.mainScreen.Resize(width, height)
+    self.altScreen.Resize(width, height)
+    self.ResetMargins()
+    self.x = min(self.x, width - 1)
+    self.y = min(self.y, height - 1)
+    self.wrapNext = False
+
+  # Cursor helpers.
+
+  def LeftMargin(self):
+    """The left margin if the cursor is within the margins, else column 0."""
+    if self.x >= self.left:
+      return self.left
+    return 0
+
+  def RightMargin(self):
+    if self.x <= self.right:
+      return self.right
+    return self.width - 1
+
+  def InMargins(self):
+    return (self.top <= self.y <= self.bottom and
+            self.left <= self.x <= self.right)
+
+  def SetCursor(self, x, y):
+    """Move the cursor to 0-based |x|, |y|, which are relative to the
+    margins in origin mode."""
+    if self.decModes[DECOM]:
+      x = min(max(x + self.left, self.left), self.right)
+      y = min(max(y + self.top, self.top), self.bottom)
+    else:
+      x = min(max(x, 0), self.width - 1)
+      y = min(max(y, 0), self.height - 1)
+    self.x = x
+    self.y = y
+    self.wrapNext = False
+
+  def CursorColumn(self):
+    """The cursor's column, relative to the left margin in origin mode."""
+    if self.decModes[DECOM]:
+      return self.x - self.left
+    return self.x
+
+  def CursorRow(self):
+    if self.decModes[DECOM]:
+      return self.y - self.top
+    return self.y
+
+  def Index(self):
+    """Move down, scrolling at the bottom margin. Outside the left and right
+    margins the cursor stops there instead."""
+    if self.y == self.bottom:
+      if self.left <= self.x <= self.right:
+        self.screen.ScrollUp(self.left, self.top, self.right + 1,
+                             self.bottom + 1, 1)
+    elif self.y < self.height - 1:
+      self.y += 1
+
+  def ReverseIndex(self):
+    if self.y == self.top:
+      if self.left <= self.x <= self.right:
+        self.screen.ScrollDown(self.left, self.top, self.right + 1,
+                               self.bottom + 1, 1)
+    elif self.y > 0:
+      self.y -= 1
+
+  def CarriageReturn(self):
+    self.x = self.LeftMargin()
+    self.wrapNext = False
+
+  def ReverseWrapEnabled(self):
+    return (self.decModes[DECAWM] and
+            (self.decModes[REVERSE_WRAP] or self.decModes[REVERSE_WRAP_EXTEND]))
+
+  def Backspace(self):
+    left = self.LeftMargin()
+    if self.wrapNext and self.ReverseWrapEnabled():
+      self.wrapNext = False
+    elif self.x > left:
+      self.x -= 1
+      self.wrapNext = False
+    elif (self.x == left and self.ReverseWrapEnabled() and
+          self.reverseWrapInline and not self.decModes[REVERSE_WRAP_EXTEND]):
+      # Only back onto the end of a row which wrapped onto this one.
+      if self.y > 0 and self.screen.IsWrapped(self.y - 1):
+        self.x = self.RightMargin()
+        self.y -= 1
+    elif self.x == left and self.ReverseWrapEnabled():
+      # Go to the end of the previous line, from the top to the bottom.
+      self.x = self.RightMargin()
+      if self.y > self.top:
+        self.y -= 1
+      elif self.decModes[REVERSE_WRAP_EXTEND]:
+        self.y = self.bottom
+      elif self.y > 0 and self.y != self.top:
+        self.y -= 1
+      else:
+        self.y = self.bottom
+
+  def Tab(self, count=1):
+    if self.wrapNext and self.decModes[DECAWM] and self.decModes[MORE_FIX]:
+      self.Wrap()
+    right = self.RightMargin()
+    for _ in range(count):
+      stops = [t for t in self.tabs if self.x < t <= right]
+      if stops:
+        self.x = min(stops)
+        self.wrapNext = False
+      elif self.x < right:
+        self.x = right
+        self.wrapNext = False
+
+  def BackTab(self, count=1):
+    # Unlike HT, CBT ignores the left margin.
+    for _ in range(count):
+      stops = [t for t in self.tabs if t < self.x]
+      if stops:
+        self.x = max(stops)
+      else:
+        self.x = 0
+    self.wrapNext = False
+
+  # Parser callbacks.
+
+  def Print(self, text):
+    for c in text:
+      self.PrintChar(c)
+
+  def PrintChar(self, c):
+    s = self.screen
+    if self.wrapNext and self.decModes[DECAWM]:
+      self.Wrap()
+    right = self.RightMargin()
+    if self.ansiModes[IRM]:
+      s.InsertCells(self.x, self.y, 1, right + 1)
+    s.Put(self.x, self.y, c, self.attrs | self.protection)
+    self.lastChar = c
+    if self.x == right:
+      self.wrapNext = True
+    elif self.x < self.width - 1:
+      self.x += 1
+
+  def Wrap(self):
+    """Move to the start of the next row from the wrap-pending position."""
+    self.wrapNext = False
+    self.screen.SetWrapped(self.y, True)
+    self.CarriageReturn()
+    self.Index()
+
+  def Execute(self, c):
+    code = ord(c)
+    if c == "\r":
+      self.CarriageReturn()
+    elif c in "\n\x0b\x0c":
+      self.Index()
+      if self.ansiModes[LNM]:
+        self.CarriageReturn()
+      self.wrapNext = False
+    elif c == "\b":
+      self.Backspace()
+    elif c == "\t":
+      self.Tab()
+    elif code == 0x84:
+      self.Index()
+      self.wrapNext = False
+    elif code == 0x85:
+      self.Index()
+      self.CarriageReturn()
+    elif code == 0x88:
+      self.tabs.add(self.x)
+    elif code == 0x8d:
+      self.ReverseIndex()
+      self.wrapNext = False
+    elif code == 0x96:
+      self.protection = screen.ISO_PROTECTED
+      self.protectedMode = screen.ISO_PROTECTED
+    elif code == 0x97:
+      self.protection = 0
+    elif code == 0x9a:
+      self.DeviceAttributes()
+
+  def EscDispatch(self, intermediates, final):
+    if intermediates == "":
+      if final in "DEHM":
+        self.Execute(chr(ord(final) + 0x40))
+      elif final == "7":
+        self.SaveCursor()
+      elif final == "8":
+        self.RestoreCursor()
+      elif final == "6":
+        self.BackIndex()
+      elif final == "9":
+        self.ForwardIndex()
+      elif final == "c":
+        self.FullReset()
+      elif final == "Z":
+        self.DeviceAttributes()
+      elif final == "V":
+        self.Execute("\x96")
+      elif final == "W":
+        self.Execute("\x97")
+    elif intermediates == "#" and final == "8":
+      self.ScreenAlignment()
+    elif intermediates == " " and final == "F":
+      self.eightBitReplies = False
+    elif intermediates == " " and final == "G":
+      if self.vtLevel >= 2:
+        self.eightBitReplies = True
+
+  def StringDispatch(self, kind, data):
+    if kind == "OSC":
+      self.OperatingSystemCommand(data)
+    elif kind == "DCS":
+      self.DeviceControlString(data)
+
+  def CsiDispatch(self, prefix, params, intermediates, final):
+    handler = CSI_HANDLERS.get((prefix, intermediates, final))
+    if handler is not None:
+      handler(self, params)
+
+  # Parameters.
+
+  @staticmethod
+  def Param(params, i, default=0):
+    """Returns parameter |i|, or |default| if it is omitted or zero."""
+    if i < len(params) and params[i]:
+      return params[i]
+    return default
+
+  @staticmethod
+  def RawParam(params, i, default=None):
+    """Returns parameter |i| even if it is zero."""
+    if i < len(params) and params[i] is not None:
+      return params[i]
+    return default
+
+  # Cursor movement.
+
+  def CUU(self, params):
+    top = self.top if self.y >= self.top else 0
+    self.y = max(top, self.y - self.Param(params, 0, 1))
+    self.wrapNext = False
+
+  def CUD(self, params):
+    bottom = self.bottom if self.y <= self.bottom else self.height - 1
+    self.y = min(bottom, self.y + self.Param(params, 0, 1))
+    self.wrapNext = False
+
+  def CUF(self, params):
+    self.x = min(self.RightMargin(), self.x + self.Param(params, 0, 1))
+    self.wrapNext = False
+
+  def CUB(self, params):
+    count = self.Param(params, 0, 1)
+    if self.wrapNext:
+      count -= 1
+      self.wrapNext = False
+    left = self.LeftMargin()
+    while count > 0:
+      if self.x > left:
+        moved = min(count, self.x - left)
+        self.x -= moved
+        count -= moved
+      elif self.ReverseWrapEnabled():
+        self.Backspace()
+        count -= 1
+      else:
+        break
+
+  def CNL(self, params):
+    self.CUD(params)
+    self.CarriageReturn()
+
+  def CPL(self, params):
+    self.CUU(params)
+    self.CarriageReturn()
+
+  def CHA(self, params):
+    self.SetCursor(self.Param(params, 0, 1) - 1, self.CursorRow())
+
+  def VPA(self, params):
+    self.SetCursor(self.CursorColumn(), self.Param(params, 0, 1) - 1)
+
+  def HPR(self, params):
+    self.SetCursor(self.CursorColumn() + self.Param(params, 0, 1),
+                   self.CursorRow())
+
+  def VPR(self, params):
+    self.SetCursor(self.CursorColumn(),
+                   self.CursorRow() + self.Param(params, 0, 1))
+
+  def CUP(self, params):
+    self.SetCursor(self.Param(params, 1, 1) - 1, self.Param(params, 0, 1) - 1)
+
+  def CHT(self, params):
+    self.Tab(self.Param(params, 0, 1))
+
+  def CBT(self, params):
+    self.BackTab(self.Param(params, 0, 1))
+
+  def TBC(self, params):
+    mode = self.RawParam(params, 0, 0)
+    if mode == 0:
+      self.tabs.discard(self.x)
+    elif mode == 3:
+      self.tabs.clear()
+
+  def ForwardIndex(self):
+    """DECFI."""
+    if self.x == self.right and self.top <= self.y <= self.bottom:
+      self.ScrollColumns(self.left, -1)
+    elif self.x < self.width - 1:
+      self.x += 1
+    self.wrapNext = False
+
+  def BackIndex(self):
+    """DECBI."""
+    if self.x == self.left and self.top <= self.y <= self.bottom:
+      self.ScrollColumns(self.left, 1)
+    elif self.x > 0:
+      self.x -= 1
+    self.wrapNext = False
+
+  # Editing.
+
+  def ScrollColumns(self, x, count):
+    """Insert |count| blank columns at |x| within the scroll region, or
+    delete -|count| columns if it is negative."""
+    for y in range(self.top, self.bottom + 1):
+      if count > 0:
+        self.screen.InsertCells(x, y, count, self.right + 1)
+      else:
+        self.screen.DeleteCells(x, y, -count, self.right + 1)
+
+  def ICH(self, params):
+    if self.left <= self.x <= self.right:
+      self.screen.InsertCells(self.x, self.y, self.Param(params, 0, 1),
+                              self.right + 1)
+    self.wrapNext = False
+
+  def DCH(self, params):
+    if self.left <= self.x <= self.right:
+      self.screen.DeleteCells(self.x, self.y, self.Param(params, 0, 1),
+                              self.right + 1)
+    self.wrapNext = False
+
+  def IL(self, params):
+    if self.InMargins():
+      self.screen.ScrollDown(self.left, self.y, self.right + 1,
+                             self.bottom + 1, self.Param(params, 0, 1))
+      self.x = self.left
+    self.wrapNext = False
+
+  def DL(self, params):
+    if self.InMargins():
+      self.screen.ScrollUp(self.left, self.y, self.right + 1,
+                           self.bottom + 1, self.Param(params, 0, 1))
+      self.x = self.left
+    self.wrapNext = False
+
+  def DECIC(self, params):
+    if self.InMargins():
+      self.ScrollColumns(self.x, self.Param(params, 0, 1))
+
+  def DECDC(self, params):
+    if self.InMargins():
+      self.ScrollColumns(self.x, -self.Param(params, 0, 1))
+
+  def SU(self, params):
+    self.screen.ScrollUp(self.left, self.top, self.right + 1, self.bottom + 1,
+                         self.Param(params, 0, 1))
+
+  def SD(self, params):
+    self.screen.ScrollDown(self.left, self.top, self.right + 1,
+                           self.bottom + 1, self.Param(params, 0, 1))
+
+  def ECH(self, params):
+    count = self.Param(params, 0, 1)
+    self.screen.Erase(self.x, self.y, min(self.width, self.x + count),
+                      self.y + 1, self.ISOProtection())
+    self.wrapNext = False
+
+  def REP(self, params):
+    if self.lastChar is not None:
+      self.Print(self.lastChar * self.Param(params, 0, 1))
+
+  def EraseInDisplay(self, mode, skip):
+    s = self.screen
+    if mode == 0:
+      s.Erase(self.x, self.y, self.width, self.y + 1, skip)
+      s.Erase(0, self.y + 1, self.width, self.height, skip)
+    elif mode == 1:
+      s.Erase(0, 0, self.width, self.y, skip)
+      s.Erase(0, self.y, self.x + 1, self.y + 1, skip)
+    elif mode == 2:
+      s.Erase(0, 0, self.width, self.height, skip)
+    self.wrapNext = False
+
+  def EraseInLine(self, mode, skip):
+    s = self.screen
+    if mode == 0:
+      s.Erase(self.x, self.y, self.width, self.y + 1, skip)
+    elif mode == 1:
+      s.Erase(0, self.y, self.x + 1, self.y + 1, skip)
+    elif mode == 2:
+      s.Erase(0, self.y, self.width, self.y + 1, skip)
+    self.wrapNext = False
+
+  def ISOProtection(self):
+    """The protection bits which ED, EL and ECH respect."""
+    if self.protectedMode == screen.ISO_PROTECTED:
+      return screen.ISO_PROTECTED
+    return 0
+
+  def SelectiveProtection(self):
+    """The protection bits which DECSED and DECSEL respect. Like xterm, they
+    respect ISO protection as well."""
+    if self.protectedMode:
+      return screen.DEC_PROTECTED | screen.ISO_PROTECTED
+    return 0
+
+  def ED(self, params):
+    self.EraseInDisplay(self.RawParam(params, 0, 0), self.ISOProtection())
+
+  def EL(self, params):
+    self.EraseInLine(self.RawParam(params, 0, 0), self.ISOProtection())
+
+  def DECSED(self, params):
+    self.EraseInDisplay(self.RawParam(params, 0, 0),
+                        self.SelectiveProtection())
+
+  def DECSEL(self, params):
+    self.EraseInLine(self.RawParam(params, 0, 0), self.SelectiveProtection())
+
+  def ScreenAlignment(self):
+    """DECALN."""
+    self.ResetMargins()
+    self.screen.Fill(0, 0, self.width, self.height, "E", 0)
+    self.x = 0
+    self.y = 0
+    self.wrapNext = False
+
+  # Rectangular operations.
+
+  def Rectangle(self, params, i):
+    """Returns the half-open rectangle given by the top, left, bottom and
+    right parameters starting at |i|, relative to the margins in origin
+    mode and clipped to the screen or the margins, or None if it is
+    empty."""
+    top = self.Param(params, i, 1) - 1
+    left = self.Param(params, i + 1, 1) - 1
+    bottom = self.Param(params, i + 2, self.height)
+    right = self.Param(params, i + 3, self.width)
+    if self.decModes[DECOM]:
+      top += self.top
+      left += self.left
+      bottom = min(bottom + self.top, self.bottom + 1)
+      right = min(right + self.left, self.right + 1)
+    bottom = min(bottom, self.height)
+    right = min(right, self.width)
+    if top >= bottom or left >= right:
+      return None
+    return left, top, right, bottom
+
+  def DECCRA(self, params):
+    source = self.Rectangle(params, 0)
+    if source is None:
+      return
+    left, top, right, bottom = source
+    y = self.Param(params, 5, 1) - 1
+    x = self.Param(params, 6, 1) - 1
+    if self.decModes[DECOM]:
+      y += self.top
+      x += self.left
+      limitX = self.right + 1
+      limitY = self.bottom + 1
+    else:
+      limitX = self.width
+      limitY = self.height
+    if x >= limitX or y >= limitY:
+      return
+    right = min(right, left + limitX - x)
+    bottom = min(bottom, top + limitY - y)
+    self.screen.Copy(left, top, right, bottom, x, y)
+
+  def DECFRA(self, params):
+    c = self.RawParam(params, 0, 0)
+    if not (32 <= c <= 126 or 160 <= c <= 255):
+      return
+    rect = self.Rectangle(params, 1)
+    if rect is not None:
+      self.screen.Fill(*rect, c=chr(c), attrs=self.attrs | self.protection)
+
+  def DECERA(self, params):
+    rect = self.Rectangle(params, 0)
+    if rect is not None:
+      self.screen.Erase(*rect)
+
+  def DECSERA(self, params):
+    rect = self.Rectangle(params, 0)
+    if rect is not None:
+      self.screen.Erase(*rect, skip=screen.DEC_PROTECTED)
+
+  def ChangeAttributesInArea(self, params, reverse):
+    rect = self.Rectangle(params, 0)
+    if rect is None:
+      return
+    set_bits = 0
+    clear_bits = 0
+    toggle_bits = 0
+    for p in params[4:] or [0]:
+      p = p or 0
+      if reverse:
+        if p == 0:
+          toggle_bits ^= (screen.BOLD | screen.UNDERLINE | screen.BLINK |
+                          screen.INVERSE)
+        elif p in RECT_ATTRIBUTES:
+          toggle_bits ^= RECT_ATTRIBUTES[p]
+      elif p == 0:
+        set_bits = 0
+        clear_bits = SGR_BITS
+      elif p in RECT_ATTRIBUTES:
+        set_bits |= RECT_ATTRIBUTES[p]
+        clear_bits &= ~RECT_ATTRIBUTES[p]
+      elif p - 20 in RECT_ATTRIBUTES:
+        clear_bits |= RECT_ATTRIBUTES[p - 20]
+        set_bits &= ~RECT_ATTRIBUTES[p - 20]
+    left, top, right, bottom = rect
+    if self.attributeExtent == 2 or bottom - top == 1:
+      self.screen.ChangeAttributes(left, top, right, bottom, set_bits,
+                                   clear_bits, toggle_bits)
+    else:
+      # The stream from the first cell to the last, wrapping at the edges.
+      self.screen.ChangeAttributes(left, top, self.width, top + 1, set_bits,
+                                   clear_bits, toggle_bits)
+      self.screen.ChangeAttributes(0, top + 1, self.width, bottom - 1,
+                                   set_bits, clear_bits, toggle_bits)
+      self.screen.ChangeAttributes(0, bottom - 1, right, bottom, set_bits,
+                                   clear_bits, toggle_bits)
+
+  def DECCARA(self, params):
+    self.ChangeAttributesInArea(params, False)
+
+  def DECRARA(self, params):
+    self.ChangeAttributesInArea(params, True)
+
+  def DECSACE(self, params):
+    self.attributeExtent = self.RawParam(params, 0, 0)
+
+  def DECRQCRA(self, params):
+    pid = self.RawParam(params, 0, 0)
+    rect = self.Rectangle(params, 2)
+    total = 0
+    if rect is not None:
+      total = self.screen.Checksum(*rect, empty_value=self.emptyChecksum)
+    if self.negateChecksum:
+      total = -total
+    self.ReplyDCS("%d!~%04X" % (pid, total & 0xffff))
+
+  # Margins.
+
+  def DECSTBM(self, params):
+    top = self.Param(params, 0, 1)
+    bottom = self.Param(params, 1, self.height)
+    bottom = min(bottom, self.height)
+    if top < bottom:
+      self.top = top - 1
+      self.bottom = bottom - 1
+      self.SetCursor(0, 0)
+
+  def SaveCursorOrSetLeftRightMargins(self, params):
+    """CSI s is DECSLRM while DECLRMM is set, and SCOSC otherwise."""
+    if not self.decModes[DECLRMM]:
+      self.SaveCursor()
+      return
+    left = self.Param(params, 0, 1)
+    right = min(self.Param(params, 1, self.width), self.width)
+    if left < right:
+      self.left = left - 1
+      self.right = right - 1
+      self.SetCursor(0, 0)
+
+  # Modes.
+
+  def SetModes(self, params, value):
+    for mode in params:
+      if mode in self.ansiModes:
+        self.ansiModes[mode] = value
+
+  def SM(self, params):
+    self.SetModes(params, True)
+
+  def RM(self, params):
+    self.SetModes(params, False)
+
+  def DECSET(self, params):
+    for mode in params:
+      self.SetDecMode(mode, True)
+
+  def DECRESET(self, params):
+    for mode in params:
+      self.SetDecMode(mode, False)
+
+  def HasDecMode(self, mode):
+    return (mode in self.decModes and
+            self.vtLevel >= DEC_MODE_LEVELS.get(mode, 1))
+
+  def SetDecMode(self, mode, value):
+    if not self.HasDecMode(mode):
+      return
+    if mode == DECCOLM:
+      if self.decModes[ALLOW_80_TO_132]:
+        self.SetColumnMode(value)
+      return
+    if mode in (ALTBUF, OPT_ALTBUF, OPT_ALTBUF_CURSOR):
+      self.SetAlternateScreen(mode, value)
+    elif mode == SAVE_CURSOR:
+      if value:
+        self.SaveCursor()
+      else:
+        self.RestoreCursor()
+    self.decModes[mode] = value
+    if mode == DECOM:
+      self.SetCursor(0, 0)
+    elif mode == DECLRMM and not value:
+      self.left = 0
+      self.right = self.width - 1
+
+  def SetColumnMode(self, wide):
+    self.decModes[DECCOLM] = wide
+    self.Resize(132 if wide else 80, self.height)
+    self.tabs = set(t for t in self.tabs if t < self.width)
+    if not self.decModes.get(DECNCSM):
+      self.screen.Erase(0, 0, self.width, self.height)
+    self.x = 0
+    self.y = 0
+
+  def SetAlternateScreen(self, mode, value):
+    if value == (self.screen is self.altScreen):
+      return
+    if value:
+      if mode == OPT_ALTBUF_CURSOR:
+        self.SaveCursor()
+      self.screen = self.altScreen
+      if mode == OPT_ALTBUF_CURSOR:
+        self.screen.Erase(0, 0, self.width, self.height)
+    else:
+      if mode == OPT_ALTBUF:
+        self.screen.Erase(0, 0, self.width, self.height)
+      self.screen = self.mainScreen
+      if mode == OPT_ALTBUF_CURSOR:
+        self.RestoreCursor()
+
+  def XTSAVE(self, params):
+    for mode in params:
+      if mode in self.decModes:
+        self.savedDecModes[mode] = self.decModes[mode]
+
+  def XTRESTORE(self, params):
+    for mode in params:
+      if mode in self.savedDecModes:
+        self.SetDecMode(mode, self.savedDecModes[mode])
+
+  def DECRQM(self, params, dec):
+    if self.vtLevel < 3:
+      return
+    mode = self.RawParam(params, 0, 0)
+    if dec:
+      modes = self.decModes
+      prefix = "?"
+    else:
+      modes = self.ansiModes
+      prefix = ""
+    if mode in (DEC_MODES_RESET if dec else ANSI_MODES_RESET):
+      setting = 4
+    elif mode not in modes or (dec and not self.HasDecMode(mode)):
+      setting = 0
+    elif modes[mode]:
+      setting = 1
+    else:
+      setting = 2
+    self.ReplyCSI("%s%d;%d$y" % (prefix, mode, setting))
+
+  # Attributes.
+
+  def SGR(self, params):
+    params = params or [0]
+    i = 0
+    while i < len(params):
+      p = params[i] or 0
+      if p == 0:
+        self.attrs = 0
+        self.fg = None
+        self.bg = None
+      elif p in SGR_ATTRIBUTES:
+        self.attrs |= SGR_ATTRIBUTES[p]
+      elif p in SGR_RESETS:
+        self.attrs &= ~SGR_RESETS[p]
+      elif 30 <= p <= 37:
+        self.fg = p - 30
+      elif 40 <= p <= 47:
+        self.bg = p - 40
+      elif 90 <= p <= 97:
+        self.fg = p - 90 + 8
+      elif 100 <= p <= 107:
+        self.bg = p - 100 + 8
+      elif p == 39:
+        self.fg = None
+      elif p == 49:
+        self.bg = None
+      elif p in (38, 48) and i + 2 < len(params) and params[i + 1] == 5:
+        if p == 38:
+          self.fg = params[i + 2]
+        else:
+          self.bg = params[i + 2]
+        i += 2
+      elif p in (38, 48) and i + 4 < len(params) and params[i + 1] == 2:
+        if p == 38:
+          self.fg = tuple(params[i + 2:i + 5])
+        else:
+          self.bg = tuple(params[i + 2:i + 5])
+        i += 4
+      i += 1
+
+  def DescribeSGR(self):
+    """Returns the parameters of SGR which select the current rendition, as
+    DECRQSS reports them."""
+    parts = ["0"]
+    for p in sorted(SGR_ATTRIBUTES):
+      if self.attrs & SGR_ATTRIBUTES[p]:
+        parts.append(str(p))
+    for color, base, brightBase, extended in [(self.fg, 30, 90, 38),
+                                              (self.bg, 40, 100, 48)]:
+      if color is None:
+        continue
+      if isinstance(color, tuple):
+        parts.append("%d:2::%d:%d:%d" % ((extended,) + color))
+      elif color < 8:
+        parts.append(str(base + color))
+      elif color < 16:
+        parts.append(str(brightBase + color - 8))
+      else:
+        parts.append("%d:5:%d" % (extended, color))
+    return ";".join(parts)
+
+  def DECSCA(self, params):
+    self.protectedMode = screen.DEC_PROTECTED
+    if self.RawParam(params, 0, 0) == 1:
+      self.protection = screen.DEC_PROTECTED
+    else:
+      self.protection = 0
+
+  def DECSCUSR(self, params):
+    self.cursorStyle = self.RawParam(params, 0, 1)
+
+  # Saving the cursor.
+
+  def SaveCursor(self):
+    saved = self.SavedCursor()
+    saved.x = self.x
+    saved.y = self.y
+    saved.attrs = self.attrs | self.protection
+    saved.fg = self.fg
+    saved.bg = self.bg
+    saved.origin = self.decModes[DECOM]
+    saved.wrapNext = self.wrapNext
+
+  def RestoreCursor(self):
+    saved = self.SavedCursor()
+    self.x = min(saved.x, self.width - 1)
+    self.y = min(saved.y, self.height - 1)
+    self.attrs = saved.attrs & ~(screen.DEC_PROTECTED | screen.ISO_PROTECTED)
+    self.protection = saved.attrs & (screen.DEC_PROTECTED |
+                                     screen.ISO_PROTECTED)
+    self.fg = saved.fg
+    self.bg = saved.bg
+    self.decModes[DECOM] = saved.origin
+    self.wrapNext = saved.wrapNext
+
+  # Conformance level.
+
+  def DECSCL(self, params):
+    level = self.RawParam(params, 0, 0)
+    if level < 61 or level - 60 > self.maxVTLevel:
+      return
+    self.SoftReset()
+    self.vtLevel = level - 60
+    controls = self.RawParam(params, 1, 0)
+    self.eightBitReplies = self.vtLevel > 1 and controls in (0, 2)
+
+  # Reports.
+
+  def DeviceAttributes(self):
+    features = {
+        1: "1;2",
+        2: "62;1;2;6;9;15;22;29",
+        3: "63;1;2;6;9;15;22;29",
+        4: "64;1;2;6;9;15;16;17;18;21;22;28;29",
+        5: "65;1;2;6;9;15;16;17;18;21;22;28;29",
+    }
+    self.ReplyCSI("?%sc" % features[self.vtLevel])
+
+  def DA(self, params):
+    if self.RawParam(params, 0, 0) == 0:
+      self.DeviceAttributes()
+
+  def DA2(self, params):
+    if self.RawParam(params, 0, 0) == 0:
+      # The terminal's identity does not change with DECSCL.
+      terminal = {1: 0, 2: 1, 3: 24, 4: 41, 5: 64}[self.maxVTLevel]
+      self.ReplyCSI(">%d;%d;0c" % (terminal, 400))
+
+  def XTVERSION(self, params):
+    if self.RawParam(params, 0, 0) == 0:
+      self.ReplyDCS(">|esctest-model(1)")
+
+  def DSR(self, params):
+    request = self.RawParam(params, 0, 0)
+    if request == 5:
+      self.ReplyCSI("0n")
+    elif request == 6:
+      self.ReplyCSI("%d;%dR" % (self.CursorRow() + 1, self.CursorColumn() + 1))
+
+  def DECDSR(self, params):
+    request = self.RawParam(params, 0, 0)
+    if request == 6:
+      if self.vtLevel >= 4:
+        self.ReplyCSI("?%d;%d;1R" % (self.CursorRow() + 1,
+                                     self.CursorColumn() + 1))
+      else:
+        self.ReplyCSI("?%d;%dR" % (self.CursorRow() + 1,
+                                   self.CursorColumn() + 1))
+    elif request == 15:
+      self.ReplyCSI("?13n")
+    elif request == 25:
+      self.ReplyCSI("?20n")
+    elif request == 26:
+      # The keyboard's status and type are reported by the VT300 and VT400
+      # series respectively.
+      self.ReplyCSI("?27;1" + ";0" * min(2, max(0, self.maxVTLevel - 2)) + "n")
+    elif request in (53, 55):
+      self.ReplyCSI("?50n")
+    elif request == 56:
+      self.ReplyCSI("?57;0n")
+    elif request == 62:
+      self.ReplyCSI("0000*{")
+    elif request == 63:
+      self.ReplyDCS("%d!~0000" % self.RawParam(params, 1, 0))
+    elif request == 75:
+      self.ReplyCSI("?70n")
+    elif request == 85:
+      self.ReplyCSI("?83n")
+
+  def DeviceControlString(self, data):
+    if data.startswith("$q"):
+      self.DECRQSS(data[2:])
+    elif data.startswith("+q"):
+      self.XTGETTCAP(data[2:])
+
+  def DECRQSS(self, setting):
+    if setting == "m":
+      value = self.DescribeSGR() + "m"
+    elif setting == "r":
+      value = "%d;%dr" % (self.top + 1, self.bottom + 1)
+    elif setting == "s":
+      value = "%d;%ds" % (self.left + 1, self.right + 1)
+    elif setting == '"q':
+      value = '%d"q' % (1 if self.protection == screen.DEC_PROTECTED else 0)
+    elif setting == '"p':
+      value = '6%d;%d"p' % (self.vtLevel, 0 if self.eightBitReplies else 1)
+    elif setting == " q":
+      value = "%d q" % self.cursorStyle
+    elif setting == "t":
+      value = "%dt" % self.height
+    elif setting == "$|":
+      value = "%d$|" % self.width
+    elif setting == "*|":
+      value = "%d*|" % self.linesPerScreen
+    elif setting == "$}":
+      value = "%d$}" % self.statusDisplay
+    elif setting == "$~":
+      value = "%d$~" % self.statusLineType
+    elif setting == "*x":
+      value = "%d*x" % self.attributeExtent
+    else:
+      self.ReplyDCS("0$r")
+      return
+    self.ReplyDCS("1$r" + value)
+
+  def XTGETTCAP(self, names):
+    for name in names.split(";"):
+      try:
+        capability = escoding.to_string(binascii.unhexlify(name))
+      except (TypeError, ValueError):
+        capability = None
+      if capability == "Co":
+        value = binascii.hexlify(escoding.to_binary(str(NUM_COLORS)))
+        self.ReplyDCS("1+r%s=%s" % (name, escoding.to_string(value).upper()))
+      else:
+        self.ReplyDCS("0+r" + name)
+
+  def DECSASD(self, params):
+    self.statusDisplay = self.RawParam(params, 0, 0)
+
+  def DECSSDT(self, params):
+    self.statusLineType = self.RawParam(params, 0, 0)
+
+  def DECSNLS(self, params):
+    lines = self.Param(params, 0, 0)
+    if lines:
+      self.linesPerScreen = lines
+      self.Resize(self.width, lines)
+
+  def DECSTR(self, params):
+    self.SoftReset()
+
+  # Window operations and titles.
+
+  def WindowOps(self, params):
+    op = self.RawParam(params, 0, 0)
+    if op >= 24:
+      self.Resize(self.width, op)
+      return
+    if op == 22:
+      self.PushTitle(self.RawParam(params, 1, 0))
+    elif op == 23:
+      self.PopTitle(self.RawParam(params, 1, 0))
+    elif op in (20, 21):
+      title = self.iconTitle if op == 20 else self.windowTitle
+      if 1 in self.titleModes:
+        title = escoding.to_string(binascii.hexlify(title.encode("utf-8")))
+      self.ReplyOSC(("L" if op == 20 else "l") + title)
+    elif op == 18:
+      self.ReplyCSI("8;%d;%dt" % (self.height, self.width))
+    elif op == 19:
+      self.ReplyCSI("9;%d;%dt" % (self.displayRows, self.displayColumns))
+    elif op == 1:
+      self.iconified = False
+    elif op == 2:
+      self.iconified = True
+    elif op == 3:
+      self.windowX = self.RawParam(params, 1, 0)
+      self.windowY = self.RawParam(params, 2, 0)
+    elif op == 4:
+      height = self.RawParam(params, 1, self.height * CHAR_HEIGHT)
+      width = self.RawParam(params, 2, self.width * CHAR_WIDTH)
+      self.ResizeWindow(width // CHAR_WIDTH if width else self.displayColumns,
+                        height // CHAR_HEIGHT if height else self.displayRows)
+    elif op == 8:
+      height = self.RawParam(params, 1, self.height)
+      width = self.RawParam(params, 2, self.width)
+      self.ResizeWindow(width or self.displayColumns,
+                        height or self.displayRows)
+    elif op in (9, 10):
+      self.Maximize(op, self.RawParam(params, 1, 0))
+    elif op == 11:
+      self.ReplyCSI("%dt" % (2 if self.iconified else 1))
+    elif op == 13:
+      self.ReplyCSI("3;%d;%dt" % (self.windowX, self.windowY))
+    elif op == 14:
+      if self.RawParam(params, 1, 0) == 2:
+        self.ReplyCSI("4;%d;%dt" % (self.height * CHAR_HEIGHT + FRAME_HEIGHT,
+                                    self.width * CHAR_WIDTH + FRAME_WIDTH))
+      else:
+        self.ReplyCSI("4;%d;%dt" % (self.height * CHAR_HEIGHT,
+                                    self.width * CHAR_WIDTH))
+    elif op == 15:
+      self.ReplyCSI("5;%d;%dt" % (DISPLAY_HEIGHT, DISPLAY_WIDTH))
+    elif op == 16:
+      self.ReplyCSI("6;%d;%dt" % (CHAR_HEIGHT, CHAR_WIDTH))
+
+  def ResizeWindow(self, width, height):
+    self.Resize(min(width, self.displayColumns),
+                min(height, self.displayRows))
+    self.x = 0
+    self.y = 0
+
+  def Maximize(self, op, how):
+    """Maximize (9) or make full-screen (10), or undo either if |how| is
+    0. Maximizing horizontally or vertically only is 3 or 2."""
+    if how == 0 or (op == 10 and how == 2 and self.unmaximizedSize):
+      if self.unmaximizedSize is not None:
+        self.ResizeWindow(*self.unmaximizedSize)
+        self.unmaximizedSize = None
+      return
+    if self.unmaximizedSize is None:
+      self.unmaximizedSize = (self.width, self.height)
+    width = self.displayColumns
+    height = self.displayRows
+    if op == 9 and how == 2:
+      width = self.width
+    elif op == 9 and how == 3:
+      height = self.height
+    self.ResizeWindow(width, height)
+
+  def PushTitle(self, which):
+    if len(self.titleStack) >= TITLE_STACK_LIMIT:
+      del self.titleStack[0]
+    # A title which is not pushed is carried over from the entry below.
+    icon = window = None
+    if self.titleStack:
+      icon, window = self.titleStack[-1]
+    if which in (0, 1):
+      icon = self.iconTitle
+    if which in (0, 2):
+      window = self.windowTitle
+    self.titleStack.append((icon, window))
+
+  def PopTitle(self, which):
+    if not self.titleStack:
+      return
+    icon, window = self.titleStack.pop()
+    if which in (0, 1) and icon is not None:
+      self.iconTitle = icon
+    if which in (0, 2) and window is not None:
+      self.windowTitle = window
+
+  def SetTitleModes(self, params):
+    self.titleModes.update(params or [0])
+
+  def ResetTitleModes(self, params):
+    self.titleModes.difference_update(params or [0])
+
+  def OperatingSystemCommand(self, data):
+    code, _, rest = data.partition(";")
+    if not code.isdigit():
+      return
+    code = int(code)
+    if code in (0, 1, 2):
+      title = rest
+      if 0 in self.titleModes:
+        try:
+          title = binascii.unhexlify(rest).decode("utf-8", "replace")
+        except (TypeError, ValueError):
+          return
+      if code in (0, 1):
+        self.iconTitle = title
+      if code in (0, 2):
+        self.windowTitle = title
+    elif code == 4:
+      self.ChangeColors(4, rest, 0)
+    elif code == 5:
+      self.ChangeColors(5, rest, NUM_COLORS)
+    elif code in DYNAMIC_COLORS:
+      self.ChangeDynamicColors(code, rest)
+    elif code == 52:
+      self.ManipulateSelection(rest)
+    elif code == 104:
+      self.ResetColors(rest, 0)
+    elif code == 105:
+      self.ResetColors(rest, NUM_COLORS)
+    elif code - 100 in DYNAMIC_COLORS and rest == "":
+      self.dynamicColors.pop(code - 100, None)
+
+  def Color(self, n):
+    if n in self.colors:
+      return self.colors[n]
+    return DefaultColor(n)
+
+  def ChangeColors(self, code, rest, offset):
+    parts = rest.split(";")
+    for i in range(0, len(parts) - 1, 2):
+      if not parts[i].isdigit():
+        continue
+      n = int(parts[i])
+      if n + offset >= NUM_COLORS + NUM_SPECIAL_COLORS:
+        continue
+      if parts[i + 1] == "?":
+        self.ReplyOSC("%d;%d;%s" % (code, n, FormatColor(self.Color(n + offset))))
+      else:
+        rgb = ParseColor(parts[i + 1])
+        if rgb is not None:
+          self.colors[n + offset] = rgb
+
+  def ResetColors(self, rest, offset):
+    if rest == "":
+      for n in list(self.colors):
+        if n >= offset:
+          del self.colors[n]
+      return
+    for part in rest.split(";"):
+      if part.isdigit():
+        self.colors.pop(int(part) + offset, None)
+
+  def ChangeDynamicColors(self, code, rest):
+    # Each value applies to the next dynamic color in turn.
+    for value in rest.split(";"):
+      if code not in DYNAMIC_COLORS:
+        break
+      if value == "?":
+        rgb = self.dynamicColors.get(code, DefaultDynamicColor(code))
+        self.ReplyOSC("%d;%s" % (code, FormatColor(rgb)))
+      else:
+        rgb = ParseColor(value)
+        if rgb is not None:
+          self.dynamicColors[code] = rgb
+      code += 1
+
+  def ManipulateSelection(self, rest):
+    if not self.windowOps:
+      return
+    targets, _, data = rest.partition(";")
+    if targets == "":
+      targets = "s0"
+    if data == "?":
+      encoded = base64.b64encode(self.selection.encode("latin-1"))
+      self.ReplyOSC("52;%s;%s" % (targets, encoded.decode("latin-1")))
+    else:
+      try:
+        self.selection = base64.b64decode(data).decode("latin-1")
+      except (ValueError, TypeError):
+        self.selection = ""
+
+CSI_HANDLERS = {
+    ("", "", "@"): Terminal.ICH,
+    ("", "", "A"): Terminal.CUU,
+    ("", "", "B"): Terminal.CUD,
+    ("", "", "C"): Terminal.CUF,
+    ("", "", "D"): Terminal.CUB,
+    ("", "", "E"): Terminal.CNL,
+    ("", "", "F"): Terminal.CPL,
+    ("", "", "G"): Terminal.CHA,
+    ("", "", "H"): Terminal.CUP,
+    ("", "", "I"): Terminal.CHT,
+    ("", "", "J"): Terminal.ED,
+    ("?", "", "J"): Terminal.DECSED,
+    ("", "", "K"): Terminal.EL,
+    ("?", "", "K"): Terminal.DECSEL,
+    ("", "", "L"): Terminal.IL,
+    ("", "", "M"): Terminal.DL,
+    ("", "", "P"): Terminal.DCH,
+    ("", "", "S"): Terminal.SU,
+    ("", "", "T"): Terminal.SD,
+    ("", "", "X"): Terminal.ECH,
+    ("", "", "Z"): Terminal.CBT,
+    ("", "", "`"): Terminal.CHA,
+    ("", "", "a"): Terminal.HPR,
+    ("", "", "b"): Terminal.REP,
+    ("", "", "c"): Terminal.DA,
+    (">", "", "c"): Terminal.DA2,
+    ("", "", "d"): Terminal.VPA,
+    ("", "", "e"): Terminal.VPR,
+    ("", "", "f"): Terminal.CUP,
+    ("", "", "g"): Terminal.TBC,
+    ("", "", "h"): Terminal.SM,
+    ("?", "", "h"): Terminal.DECSET,
+    ("", "", "l"): Terminal.RM,
+    ("?", "", "l"): Terminal.DECRESET,
+    ("", "", "m"): Terminal.SGR,
+    ("", "", "n"): Terminal.DSR,
+    ("?", "", "n"): Terminal.DECDSR,
+    ("", "!", "p"): Terminal.DECSTR,
+    ("", '"', "p"): Terminal.DECSCL,
+    ("", "$", "p"): lambda self, params: self.DECRQM(params, False),
+    ("?", "$", "p"): lambda self, params: self.DECRQM(params, True),
+    ("", '"', "q"): Terminal.DECSCA,
+    ("", " ", "q"): Terminal.DECSCUSR,
+    (">", "", "q"): Terminal.XTVERSION,
+    ("", "", "r"): Terminal.DECSTBM,
+    ("?", "", "r"): Terminal.XTRESTORE,
+    ("", "$", "r"): Terminal.DECCARA,
+    ("", "", "s"): Terminal.SaveCursorOrSetLeftRightMargins,
+    ("?", "", "s"): Terminal.XTSAVE,
+    ("", "", "t"): Terminal.WindowOps,
+    (">", "", "t"): Terminal.SetTitleModes,
+    (">", "", "T"): Terminal.ResetTitleModes,
+    ("", "$", "t"): Terminal.DECRARA,
+    ("", "", "u"): lambda self, params: self.RestoreCursor(),
+    ("", "$", "v"): Terminal.DECCRA,
+    ("", "$", "x"): Terminal.DECFRA,
+    ("", "*", "x"): Terminal.DECSACE,
+    ("", "*", "y"): Terminal.DECRQCRA,
+    ("", "$", "z"): Terminal.DECERA,
+    ("", "$", "{"): Terminal.DECSERA,
+    ("", "*", "|"): Terminal.DECSNLS,
+    ("", "$", "}"): Terminal.DECSASD,
+    ("", "'", "}"): Terminal.DECIC,
+    ("", "$", "~"): Terminal.DECSSDT,
+    ("", "'", "~"): Terminal.DECDC,
+}
@@ -0,0 +1,118 @@
+'''
+Connects escio to the model in place of a real terminal, or alongside one.
+'''
+
+import re
+
+import escoding
+import esctypes
+
+# Where a piece of output is split so that each reply of the model can be
+# traced to the sequence which asked for it: before each ESC, except the
+# ESC of a string terminator.
+SEQUENCE_START_RE = re.compile(b"\x1b(?!\\\\)")
+
+class ModelTransport(object):
+  """An escio transport whose output goes to a model.Terminal, which answers
+  immediately. A read finds nothing if no reply is pending, since none can
+  arrive later."""
+  def __init__(self, terminal):
+    self.terminal = terminal
+
+  def Write(self, data):
+    self.terminal.Feed(data)
+
+  def Read(self, timeout):
+    data = self.terminal.TakeReplies()
+    if len(data) == 0:
+      raise esctypes.InternalError("Timeout waiting to read.")
+    return data
+
+  def Close(self):
+    pass
+
+class DifferentialTransport(object):
+  """An escio transport which sends everything to both a real terminal,
+  through |transport|, and a model.Terminal, and compares the real
+  terminal's replies with the model's as they arrive. Only the real
+  terminal's replies are returned.
+
+  The first difference since ClearDivergence() is kept in |divergence|,
+  naming the sequence whose reply differed."""
+  def __init__(self, transport, terminal):
+    self._transport = transport
+    self.terminal = terminal
+    # The model's replies which the real terminal has yet to match, as
+    # (request, reply) pairs, and what it has sent towards the first of them.
+    self._expected = []
+    self._received = b""
+    self._lastRequest = b""
+    self.divergence = None
+
+  def ClearDivergence(self):
+    self.divergence = None
+
+  def Write(self, data):
+    self._transport.Write(data)
+    for piece in Pieces(data):
+      self.terminal.Feed(piece)
+      self._lastRequest = piece
+      reply = self.terminal.TakeReplies()
+      if len(reply) > 0:
+        self._expected.append((piece, reply))
+
+  def Read(self, timeout):
+    try:
+      data = self._transport.Read(timeout)
+    except esctypes.InternalError:
+      if timeout > 0 and self._expected:
+        request, reply = self._expected[0]
+        self.Diverged(request, self._received, reply)
+      raise
+    self.Compare(data)
+    return data
+
+  def Close(self):
+    self._transport.Close()
+
+  def Compare(self, data):
+    """Match |data| from the real terminal against the model's replies."""
+    received = self._received + data
+    while len(received) > 0:
+      if not self._expected:
+        self.Diverged(self._lastRequest, received, b"")
+        return
+      request, reply = self._expected[0]
+      n = min(len(reply), len(received))
+      if reply[:n] != received[:n]:
+        # What follows is most likely the replies to later requests.
+        self.Diverged(request, received[:len(reply)], reply)
+        return
+      if n < len(reply):
+        # Wait for the rest of the reply.
+        break
+      del self._expected[0]
+      received = received[n:]
+    self._received = received
+
+  def Diverged(self, request, actual, expected):
+    """Note a difference, and forget the replies still expected: after one,
+    the real terminal's replies cannot be paired with the model's."""
+    del self._expected[:]
+    self._received = b""
+    if self.divergence is None:
+      self.divergence = "after %s the terminal sent %s but the model sent %s" % (
+          Describe(request), Describe(actual), Describe(expected))
+
+def Pieces(data):
+  """Split |data| before each sequence it contains."""
+  start = 0
+  for m in SEQUENCE_START_RE.finditer(data, 1):
+    yield data[start:m.start()]
+    start = m.start()
+  yield data[start:]
+
+def Describe(data):
+  if len(data) == 0:
+    return "nothing"
+  return repr(escoding.to_string(data))
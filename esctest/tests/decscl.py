@@ -34,7 +34,7 @@ class DECSCLTests(object):
     # Make sure DECRQM fails.
     try:
       esccmd.DECRQM(esccmd.IRM, DEC=False)
-      escio.ReadCSI('$y')
+      escio.ReadCSI('$y', sentinel=True)
       # Should not get here.
       AssertTrue(False)
     except InternalError:
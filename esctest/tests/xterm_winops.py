@@ -2,13 +2,14 @@ import time
 
 import escargs
 import esccmd
+import escio
 import esclog
 
 from escutil import AssertEQ, AssertTrue, GetDisplaySize, GetIconTitle
 from escutil import GetIsIconified, GetScreenSize, GetWindowPosition
 from escutil import GetCharSizePixels, GetFrameSizePixels, GetScreenSizePixels
 from escutil import GetWindowSizePixels, GetWindowTitle, knownBug
-from escutil import CanQueryShellSize
+from escutil import CanQueryShellSize, UniqueString
 from esctypes import Point, Size
 
 # No tests for the following operations:
@@ -23,22 +24,28 @@ class XtermWinopsTests(object):
   def DelayAfterIcon(cls):
     """Account for time needed by window manager to iconify/deiconify a
     window."""
-    need_sleep = escargs.args.expected_terminal in ["xterm"]
+    need_sleep = (escargs.args.expected_terminal in ["xterm"] and
+                  not escargs.args.headless and not escargs.args.replay)
     if need_sleep:
+      escio.Flush()
       time.sleep(1)
 
   @classmethod
   def DelayAfterMove(cls):
     """Account for time needed by window manager to move a window."""
-    need_sleep = escargs.args.expected_terminal in ["xterm"]
+    need_sleep = (escargs.args.expected_terminal in ["xterm"] and
+                  not escargs.args.headless and not escargs.args.replay)
     if need_sleep:
+      escio.Flush()
       time.sleep(0.1)
 
   @classmethod
   def DelayAfterResize(cls):
     """Account for time needed by window manager to resize a window."""
-    need_sleep = escargs.args.expected_terminal in ["xterm"]
+    need_sleep = (escargs.args.expected_terminal in ["xterm"] and
+                  not escargs.args.headless and not escargs.args.replay)
     if need_sleep:
+      escio.Flush()
       time.sleep(1)
 
   @classmethod
@@ -552,22 +559,21 @@ class XtermWinopsTests(object):
   @classmethod
   @knownBug(terminal="iTerm2", reason="Not implemented")
   def test_XtermWinops_ReportIconLabel(cls):
-    string = "test " + str(time.time())
+    string = "test " + UniqueString()
     esccmd.ChangeIconTitle(string)
     AssertEQ(GetIconTitle(), string)
 
   @classmethod
   @knownBug(terminal="iTerm2", reason="Not implemented")
   def test_XtermWinops_ReportWindowLabel(cls):
-    string = "test " + str(time.time())
+    string = "test " + UniqueString()
     esccmd.ChangeWindowTitle(string)
     AssertEQ(GetWindowTitle(), string)
 
   @classmethod
   def test_XtermWinops_PushIconAndWindow_PopIconAndWindow(cls):
     """Basic test: Push an icon & window title and restore it."""
-    # Generate a uniqueish string
-    string = str(time.time())
+    string = UniqueString()
 
     # Set the window and icon title, then push both.
     esccmd.ChangeWindowAndIconTitle(string)
@@ -597,8 +603,7 @@ class XtermWinopsTests(object):
             + " when popping the icon title.")
   def test_XtermWinops_PushIconAndWindow_PopIcon(cls):
     """Push an icon & window title and pop just the icon title."""
-    # Generate a uniqueish string
-    string = str(time.time())
+    string = UniqueString()
 
     # Set the window and icon title, then push both.
     esccmd.ChangeWindowAndIconTitle(string)
@@ -634,8 +639,7 @@ class XtermWinopsTests(object):
             + " when popping the icon title.")
   def test_XtermWinops_PushIconAndWindow_PopWindow(cls):
     """Push an icon & window title and pop just the window title."""
-    # Generate a uniqueish string
-    string = str(time.time())
+    string = UniqueString()
 
     # Set the window and icon title, then push both.
     esccmd.ChangeWindowAndIconTitle(string)
@@ -665,8 +669,7 @@ class XtermWinopsTests(object):
   @classmethod
   def test_XtermWinops_PushIcon_PopIcon(cls):
     """Push icon title and then pop it."""
-    # Generate a uniqueish string
-    string = str(time.time())
+    string = UniqueString()
 
     # Set the window and icon title, then push both.
     esccmd.ChangeWindowTitle("x")
@@ -686,8 +689,7 @@ class XtermWinopsTests(object):
   @classmethod
   def test_XtermWinops_PushWindow_PopWindow(cls):
     """Push window title and then pop it."""
-    # Generate a uniqueish string
-    string = str(time.time())
+    string = UniqueString()
 
     # Set the window and icon title, then push both.
     esccmd.ChangeIconTitle("x")
@@ -707,9 +709,8 @@ class XtermWinopsTests(object):
   @classmethod
   def test_XtermWinops_PushIconThenWindowThenPopBoth(cls):
     """Push icon, then push window, then pop both."""
-    # Generate a uniqueish string
-    string1 = "a" + str(time.time())
-    string2 = "b" + str(time.time())
+    string1 = "a" + UniqueString()
+    string2 = "b" + UniqueString()
 
     # Set titles
     esccmd.ChangeWindowTitle(string1)
@@ -734,9 +735,8 @@ class XtermWinopsTests(object):
   @classmethod
   def test_XtermWinops_PushMultiplePopMultiple_Icon(cls):
     """Push two titles and pop twice."""
-    # Generate a uniqueish string
-    string1 = "a" + str(time.time())
-    string2 = "b" + str(time.time())
+    string1 = "a" + UniqueString()
+    string2 = "b" + UniqueString()
 
     for title in [string1, string2]:
       # Set title
@@ -762,9 +762,8 @@ class XtermWinopsTests(object):
   @classmethod
   def test_XtermWinops_PushMultiplePopMultiple_Window(cls):
     """Push two titles and pop twice."""
-    # Generate a uniqueish string
-    string1 = "a" + str(time.time())
-    string2 = "b" + str(time.time())
+    string1 = "a" + UniqueString()
+    string2 = "b" + UniqueString()
 
     for title in [string1, string2]:
       # Set title